@@ -0,0 +1,182 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+
+import aiohttp
+
+from configurable import Configurable
+from metrics import metrics
+from tools import api_error, api_params, api_url, Database, retry_reason
+
+
+class AsyncAPIRequest():
+
+    def __init__(self, session, scheduler, limiter, base_url, per_key=20, cache=None, executor=None):
+        self.session = session
+        self.cache = cache
+        self.executor = executor  # Runs the blocking response cache calls outside the event loop
+        self.scheduler = scheduler
+        self.limiter = limiter
+        self.base_url = base_url
+        self.semaphores = {k: asyncio.Semaphore(per_key) for k in scheduler.keys}  # Concurrency limit for each key
+
+    async def fetch(self, key, collection, fields):
+        async with self.semaphores[key]:
+            async with self.session.get(api_url(self.base_url, collection),
+                                        params=api_params(collection, fields, key)) as resp:
+                return resp.status, await resp.read()
+
+    async def list(self, collection, **fields):
+        # Returns the request fields in place of a request object, so list_next can request the following page
+        if not self.cache:
+            return fields, await self.execute(collection, fields)
+        loop = asyncio.get_running_loop()
+        items, missing = await loop.run_in_executor(self.executor, self.cache.lookup, collection, fields)
+        response = await self.execute(collection, missing) if missing else {}
+        return fields, await loop.run_in_executor(self.executor, self.cache.update, collection, fields, missing, items,
+                                                  response)
+
+    async def execute(self, collection, fields):
+        attempt = 0
+        while True:
+            key = self.scheduler.acquire(collection)
+            await asyncio.sleep(self.limiter.reserve(key))
+            try:
+                with metrics.timer('api_seconds', endpoint=collection):
+                    status, content = await self.fetch(key, collection, fields)
+                metrics.count('api_responses', endpoint=collection, status=status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                metrics.count('api_responses', endpoint=collection, status='error')
+                if attempt + 1 >= self.limiter.attempts:
+                    raise err
+            else:
+                if status < 400:
+                    self.limiter.success(key)
+                    return json.loads(content)
+                reason = retry_reason(status, content)
+                if reason == 'quota':
+                    self.scheduler.exhaust(key)  # The next attempt goes out with another key
+                elif reason == 'throttle':
+                    self.limiter.throttled(key)
+                if not reason or attempt + 1 >= self.limiter.attempts:
+                    raise api_error(status, content)
+            await asyncio.sleep(self.limiter.backoff(attempt))
+            attempt += 1
+
+    async def list_next(self, collection, request=None, response=None):
+        if request and response and response.get('nextPageToken'):
+            return await self.list(collection, **dict(request, pageToken=response['nextPageToken']))
+        return None, None
+
+
+class AsyncEngine(Configurable):
+
+    def __init__(self, monitor):
+        super().__init__(fields=['api', 'database'])
+        self.monitor = monitor
+        settings = self.config['api'].get('async') or {}
+        self.workers = settings.get('channels', 1000)
+        self.per_key = settings.get('perKey', 20)
+        self.connections = settings.get('connections', 100)
+        self.base_url = self.config['api'].get('baseUrl', 'https://www.googleapis.com/youtube/v3')
+        self.db = Database()
+        # Blocking database calls run outside the event loop, one thread per pooled connection
+        self.executor = ThreadPoolExecutor(max_workers=(self.config['database'].get('pool') or {}).get('size', 10),
+                                           thread_name_prefix='async_db')
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.executor.shutdown()
+
+    async def main(self):
+        channels = asyncio.Queue(maxsize=self.workers)
+        connector = aiohttp.TCPConnector(limit=self.connections)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            api = AsyncAPIRequest(session, self.monitor.scheduler, self.monitor.limiter, self.base_url,
+                                  per_key=self.per_key, cache=self.monitor.cache, executor=self.executor)
+            await asyncio.gather(self.feed(channels), *[self.worker(api, channels) for _ in range(self.workers)])
+        self.monitor.logger.info('Finished execution for async engine.')
+
+    async def run_db(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def feed(self, channels):  # Moves channels from the monitor's bounded api_queue into the event loop
+        loop = asyncio.get_running_loop()
+        while True:
+            channel_id = await loop.run_in_executor(None, self.monitor.api_queue.get)
+            await channels.put(channel_id)
+            if channel_id is None:
+                return
+
+    async def worker(self, api, channels):
+        while True:
+            channel_id = await channels.get()
+            if channel_id is None:
+                await channels.put(None)  # Lets the next worker stop as well
+                return
+            try:
+                await self.collect_info(api, channel_id)
+            except Exception as err:
+                self.monitor.logger.error('Failed to collect channel {}: {}'.format(channel_id, repr(err)))
+
+    async def resolve_channel(self, api, channel_id):
+        m = self.monitor
+        await self.run_db(m.lookup_ids, self.db, 'channel', [channel_id])
+        if channel_id not in m.ids['channel']:
+            request, response = await api.list('channels', part='snippet', id=channel_id)
+            channel_dbid = await self.run_db(self.db.insert, 'channel',
+                                             m.channel_row(channel_id, response['items'][0]['snippet']))
+            m.ids['channel'][channel_id] = channel_dbid
+        return m.ids['channel'][channel_id]
+
+    async def resolve_videos(self, api, channel_dbid, video_ids):
+        m = self.monitor
+        missing = [v for v in video_ids if v not in m.ids['video']]
+        if missing:
+            await self.run_db(m.lookup_ids, self.db, 'video', missing)
+            missing = [v for v in missing if v not in m.ids['video']]
+        if missing:
+            rows = []
+            for r in m.chunks(missing, self.config['api']['videos']['maxResults']):
+                request, response = await api.list('videos', part='snippet,contentDetails', id=','.join(r))
+                rows.extend(m.video_rows(response, channel_dbid))
+            if rows:
+                await self.run_db(self.db.insert, 'video', rows)
+                await self.run_db(m.lookup_ids, self.db, 'video', [r['yt_id'] for r in rows])
+        return [v for v in video_ids if v in m.ids['video']]
+
+    async def collect_info(self, api, channel_id):
+        m = self.monitor
+        channel_dbid = m.ids['channel'].get(channel_id, 0)
+        if not channel_dbid:
+            channel_dbid = await self.resolve_channel(api, channel_id)
+
+        request, response = await api.list('channels', part='statistics', id=channel_id)
+        m.writer.put(m.collect_channel_row(channel_id, response))
+
+        request, response = await api.list('playlistItems', part='contentDetails', playlistId='UU' + channel_id[2:],
+                                           maxResults=50)
+        watermark = await self.run_db(m.state.watermark, channel_id)
+        new_videos = []
+        done = False
+        while request and not done:
+            page, done = m.page_videos(response, watermark)
+            video_list = await self.resolve_videos(api, channel_dbid, [v for v, p in page])
+            new_videos.extend(page)
+            await self.collect_videos(api, channel_id, video_list)
+            if not done:
+                request, response = await api.list_next('playlistItems', request, response)
+
+        seen = set(v for v, p in new_videos)
+        await self.collect_videos(api, channel_id, await self.run_db(m.active_videos, self.db, channel_id, seen))
+        await self.run_db(m.state.update_channel, channel_id, new_videos, (m.now - m.limit).isoformat())
+        m.channel_done(channel_id)
+
+    async def collect_videos(self, api, channel_id, videos):
+        m = self.monitor
+        for r in m.chunks(videos):
+            request, response = await api.list('videos', part='statistics', id=','.join(r))
+            for query in m.collect_video_rows(channel_id, response):
+                m.writer.put(query)
@@ -0,0 +1,121 @@
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+import json
+import logging
+from os import chdir, devnull, getcwd, makedirs
+from os.path import abspath, dirname, join
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+from time import perf_counter
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, dirname(abspath(__file__)))
+import async_engine  # noqa: E402
+import channel_monitor  # noqa: E402
+import tools  # noqa: E402
+from fake_api import FakeYouTube  # noqa: E402
+from sqlite_db import SQLiteDatabase, TABLES  # noqa: E402
+
+# End-to-end benchmark of Monitor against the fake API in fake_api.py and the SQLite database in sqlite_db.py, in a
+# temporary directory. No quota is spent and MySQL is not needed. Each run is a full collect of every channel; later
+# runs start from the state, ID indexes and response cache left by the earlier ones, as in production.
+# Usage: python benchmarks/bench_monitor.py [--channels 200] [--runs 2] [--engine threads] [--output results.json]
+
+
+def configure(args, port):  # config.json of the repository, pointed at the fake API and local files
+    with open(join(ROOT, 'config.json'), 'r') as f:
+        config = json.loads(f.read())
+    config['api'].update({'keys': ['bench-key-{}'.format(i) for i in range(args.keys)],
+                          'baseUrl': 'http://127.0.0.1:{}'.format(port), 'threads': args.threads,
+                          'rateLimit': {'rate': 1000, 'burst': 1000, 'minRate': 100, 'maxRate': 10000},
+                          'retry': {'attempts': 3, 'baseDelay': 0.1, 'maxDelay': 1},
+                          'quota': {'daily': 10 ** 9, 'timezone': 'America/Los_Angeles'}})
+    config['api']['cache'] = dict(config['api'].get('cache') or {}, file='response_cache.db' if args.cache else '',
+                                  offline=False, record=False)
+    config['api']['videos']['dateLimit'] = args.date_limit
+    config['files'].update({'collectIdFile': 'ID.COLLECT', 'logDirectory': 'logs', 'stateFile': 'monitor_state.db',
+                            'quotaFile': 'quota.json', 'indexDirectory': '.', 'statsDirectory': 'stats',
+                            'spillDirectory': 'spill'})
+    config['database'].update({'tables': TABLES, 'writers': args.writers, 'flushInterval': 1,
+                               'loadDataThreshold': 0})
+    config['server']['metricsPort'] = 0
+    with open('config.json', 'w') as f:
+        f.write(json.dumps(config, indent=4))
+    with open('ID.COLLECT', 'w') as f:
+        f.write('1')
+    makedirs('logs', exist_ok=True)
+
+
+def collect(args, api):
+    api.calls.clear()
+    SQLiteDatabase.calls = {}
+    start = perf_counter()
+    with open(devnull, 'w') as out, redirect_stdout(out):  # The monitor prints the queue size for every channel
+        monitor = channel_monitor.Monitor(engine=args.engine)
+    seconds = perf_counter() - start
+    logging.getLogger('Monitor').handlers.clear()
+    channels = monitor.stats['channels'] or 1
+    api_calls = sum(api.calls.values())
+    db_calls = sum(SQLiteDatabase.calls.values())
+    return {'collect_id': monitor.collect_id, 'seconds': round(seconds, 3), 'channels': monitor.stats['channels'],
+            'channels_per_second': round(monitor.stats['channels'] / seconds, 1), 'rows': monitor.stats['rows'],
+            'api_calls': dict(api.calls), 'api_calls_per_channel': round(api_calls / channels, 2),
+            'db_calls': dict(SQLiteDatabase.calls), 'db_round_trips_per_channel': round(db_calls / channels, 2),
+            'cache': monitor.cache.counters() if monitor.cache else {}}
+
+
+def main():
+    parser = ArgumentParser(description='Benchmarks Monitor against a fake YouTube API and a SQLite database.')
+    parser.add_argument('--channels', type=int, default=200)
+    parser.add_argument('--uploads', type=float, default=0.5, help='Median uploads per channel per day.')
+    parser.add_argument('--days', type=int, default=60, help='Days of upload history of each channel.')
+    parser.add_argument('--date-limit', type=int, default=7, help='api.videos.dateLimit of the runs.')
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--keys', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every API response.')
+    parser.add_argument('--cache', action='store_true', help='Enables the response cache.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Writes the results to this JSON file.')
+    parser.add_argument('--keep', action='store_true', help='Keeps the temporary directory of the runs.')
+    args = parser.parse_args()
+
+    api = FakeYouTube(channels=args.channels, days=args.days, uploads_per_day=args.uploads, seed=args.seed)
+    server = api.serve(latency=args.latency)
+    cwd = getcwd()
+    directory = mkdtemp(prefix='bench_monitor_')
+    chdir(directory)
+    results = []
+    try:
+        configure(args, server.server_address[1])
+        SQLiteDatabase.open('bench.db')
+        SQLiteDatabase().insert('channel', [{'yt_id': c} for c in api.channels])  # The channel list to collect
+        for module in (tools, channel_monitor, async_engine):
+            module.Database = SQLiteDatabase
+        for i in range(args.runs):
+            results.append(collect(args, api))
+            r = results[-1]
+            print('Run {}: {} channels in {:.2f} s ({} channels/s), {} API calls and {} DB round trips per channel, '
+                  'rows {}'.format(i + 1, r['channels'], r['seconds'], r['channels_per_second'],
+                                   r['api_calls_per_channel'], r['db_round_trips_per_channel'], r['rows']))
+    finally:
+        server.shutdown()
+        chdir(cwd)
+        if args.keep:
+            print('Files kept in {}'.format(directory))
+        else:
+            rmtree(directory, ignore_errors=True)
+    summary = {'videos': len(api.videos), 'args': vars(args), 'runs': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(summary, indent=4))
+    else:
+        print(json.dumps(summary, indent=4))
+
+
+if __name__ == '__main__':
+    main()
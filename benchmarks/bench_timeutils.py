@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+from os.path import abspath, dirname
+import sys
+from timeit import repeat
+
+from isodate import parse_duration as parse_iso
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from timeutils import format_timestamp, parse_duration, parse_timestamp  # noqa: E402
+
+# Compares the per-video cost of parsing publishedAt and duration with strptime and isodate (as channel_monitor.py
+# did before timeutils) against the fixed-format parsers. Usage: python benchmarks/bench_timeutils.py [videos]
+
+VIDEOS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+OFFSET = -3
+SAMPLES = [('2021-03-{:02d}T{:02d}:{:02d}:{:02d}{}Z'.format(i % 28 + 1, i % 24, i % 60, (i * 7) % 60,
+                                                             '.{:03d}'.format(i % 1000) if i % 2 else ''),
+            'PT{}H{}M{}S'.format(i % 3, i % 60, (i * 13) % 60) if i % 3 else 'PT{}M{}S'.format(i % 60, i % 59))
+           for i in range(1000)]
+SAMPLES = (SAMPLES * (VIDEOS // len(SAMPLES) + 1))[:VIDEOS]
+
+
+def before():
+    for published_at, duration in SAMPLES:
+        d = datetime.strptime(published_at[:-1].split('.')[0], '%Y-%m-%dT%H:%M:%S') + timedelta(hours=OFFSET)
+        d.strftime('%Y-%m-%d %H:%M:%S')
+        int(parse_iso(duration).total_seconds())
+
+
+def after():
+    offset = timedelta(hours=OFFSET)
+    for published_at, duration in SAMPLES:
+        format_timestamp(parse_timestamp(published_at, offset))
+        parse_duration(duration)
+
+
+def check():  # Both versions must give the same results
+    offset = timedelta(hours=OFFSET)
+    for published_at, duration in SAMPLES[:1000]:
+        old = datetime.strptime(published_at[:-1].split('.')[0], '%Y-%m-%dT%H:%M:%S') + timedelta(hours=OFFSET)
+        if format_timestamp(parse_timestamp(published_at, offset)) != old.strftime('%Y-%m-%d %H:%M:%S'):
+            raise Exception('(bench_timeutils.py) Timestamp mismatch: {}'.format(published_at))
+        if parse_duration(duration) != int(parse_iso(duration).total_seconds()):
+            raise Exception('(bench_timeutils.py) Duration mismatch: {}'.format(duration))
+
+
+if __name__ == '__main__':
+    check()
+    results = {}
+    for name, func in (('strptime + isodate', before), ('timeutils', after)):
+        results[name] = min(repeat(func, number=1, repeat=5))
+        print('{:<20} {:>8.3f} s  {:>7.2f} us/video'.format(name, results[name], results[name] / VIDEOS * 1e6))
+    print('Speedup: {:.1f}x'.format(results['strptime + isodate'] / results['timeutils']))
@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta, timezone
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from random import Random
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qsl, urlsplit
+
+# Local stand-in for the channels, playlistItems and videos endpoints of the YouTube Data API, serving synthetic
+# channels. Upload rates per channel follow a lognormal distribution (most channels post a few videos a week, a few
+# post many a day), uploads arrive as a Poisson process and views grow with the age of each video
+
+
+def fake_id(prefix, n, length):  # Deterministic YouTube-like ID
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+    digest = md5('{}{}'.format(prefix, n).encode()).digest()
+    return ''.join(alphabet[b % 64] for b in digest * 2)[:length]
+
+
+def timestamp(d):
+    return d.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class FakeYouTube():
+
+    def __init__(self, channels=100, days=60, uploads_per_day=0.5, seed=1):
+        rng = Random(seed)
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.channels = {}  # Channel ID: channel data with its uploads, newest first
+        self.videos = {}
+        for c in range(channels):
+            channel_id = 'UC' + fake_id('channel', c, 22)
+            rate = uploads_per_day * rng.lognormvariate(0, 1.2)  # Median uploads_per_day, long tail
+            uploads = []
+            age = rng.expovariate(rate) if rate else days
+            while age < days:
+                video_id = fake_id(channel_id, len(uploads), 11)
+                published_at = now - timedelta(days=age)
+                self.videos[video_id] = {'channel_id': channel_id, 'published_at': published_at,
+                                         'duration': int(rng.lognormvariate(6, 1)) + 1,
+                                         'views_per_day': int(rng.lognormvariate(6, 2)), 'age': age}
+                uploads.append(video_id)
+                age += rng.expovariate(rate)
+            self.channels[channel_id] = {'title': 'Channel {}'.format(c), 'uploads': uploads,
+                                         'subscribers': int(rng.lognormvariate(9, 2)),
+                                         'published_at': now - timedelta(days=days + rng.randint(0, 3000))}
+        self.calls = {}
+        self.lock = Lock()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def channel_items(self, params):
+        items = []
+        for channel_id in params.get('id', '').split(','):
+            channel = self.channels.get(channel_id)
+            if not channel:
+                continue
+            item = {'kind': 'youtube#channel', 'id': channel_id}
+            if 'snippet' in params['part']:
+                item['snippet'] = {'title': channel['title'], 'description': 'Synthetic channel',
+                                   'publishedAt': timestamp(channel['published_at'])}
+            if 'statistics' in params['part']:
+                item['statistics'] = {'subscriberCount': str(channel['subscribers']),
+                                      'videoCount': str(len(channel['uploads']))}
+            items.append(item)
+        return {'kind': 'youtube#channelListResponse', 'items': items}
+
+    def playlist_items(self, params):
+        channel = self.channels.get('UC' + params.get('playlistId', '')[2:])
+        if not channel:
+            return None
+        size = min(int(params.get('maxResults', 5)), 50)
+        start = int(params.get('pageToken') or 0)
+        page = channel['uploads'][start:start + size]
+        response = {'kind': 'youtube#playlistItemListResponse',
+                    'items': [{'kind': 'youtube#playlistItem',
+                               'contentDetails': {'videoId': v,
+                                                  'videoPublishedAt': timestamp(self.videos[v]['published_at'])}}
+                              for v in page],
+                    'pageInfo': {'totalResults': len(channel['uploads']), 'resultsPerPage': size}}
+        if start + size < len(channel['uploads']):
+            response['nextPageToken'] = str(start + size)
+        return response
+
+    def video_items(self, params):
+        items = []
+        for video_id in params.get('id', '').split(','):
+            video = self.videos.get(video_id)
+            if not video:
+                continue
+            item = {'kind': 'youtube#video', 'id': video_id}
+            if 'snippet' in params['part']:
+                item['snippet'] = {'title': 'Video {}'.format(video_id), 'description': 'Synthetic video',
+                                   'channelId': video['channel_id'], 'publishedAt': timestamp(video['published_at'])}
+            if 'contentDetails' in params['part']:
+                m, s = divmod(video['duration'], 60)
+                h, m = divmod(m, 60)
+                item['contentDetails'] = {'duration': 'PT{}H{}M{}S'.format(h, m, s) if h else 'PT{}M{}S'.format(m, s)}
+            if 'statistics' in params['part']:
+                views = int(video['views_per_day'] * video['age'])
+                item['statistics'] = {'viewCount': str(views), 'likeCount': str(views // 30),
+                                      'commentCount': str(views // 300)}
+            items.append(item)
+        return {'kind': 'youtube#videoListResponse', 'items': items}
+
+    def respond(self, endpoint, params):
+        self.count(endpoint)
+        handler = {'channels': self.channel_items, 'playlistItems': self.playlist_items,
+                   'videos': self.video_items}.get(endpoint)
+        if not handler or 'part' not in params:
+            return 400, {'error': {'code': 400, 'message': 'Bad request', 'errors': [{'reason': 'badRequest'}]}}
+        response = handler(params)
+        if response is None:
+            return 404, {'error': {'code': 404, 'errors': [{'reason': 'playlistNotFound'}]}}
+        return 200, response
+
+    def serve(self, port=0, latency=0.0):  # Starts the server on a daemon thread. Returns it, bound to a free port
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if latency:
+                    sleep(latency)
+                status, response = api.respond(url.path.rstrip('/').split('/')[-1], dict(parse_qsl(url.query)))
+                body = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, name='fake_api', daemon=True).start()
+        return server
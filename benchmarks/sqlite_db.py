@@ -0,0 +1,114 @@
+from os.path import abspath, dirname
+import sqlite3
+import sys
+from threading import Lock
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from tools import Database  # noqa: E402
+
+# SQLite stand-in for tools.Database, with the tables used by channel_monitor.py. It takes the same calls and SQL the
+# monitor sends to MySQL, and counts the round trips of each call
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS channel (channel_id INTEGER PRIMARY KEY AUTOINCREMENT, yt_id TEXT UNIQUE, title TEXT,
+                                        description TEXT, published_at TEXT, cluster TEXT);
+    CREATE TABLE IF NOT EXISTS video (video_id INTEGER PRIMARY KEY AUTOINCREMENT, yt_id TEXT UNIQUE, title TEXT,
+                                      description TEXT, channel_id INTEGER, length_seconds INTEGER, published_at TEXT);
+    CREATE TABLE IF NOT EXISTS collect_channel (collect_id INTEGER, channel_id INTEGER, subscriber_count INTEGER,
+                                                collected_at TEXT, PRIMARY KEY (collect_id, channel_id));
+    CREATE TABLE IF NOT EXISTS collect_video (collect_id INTEGER, video_id INTEGER, like_count INTEGER,
+                                              dislike_count INTEGER, view_count INTEGER, comment_count INTEGER,
+                                              collected_at TEXT, PRIMARY KEY (collect_id, video_id));
+    CREATE TABLE IF NOT EXISTS video_daily (video_id INTEGER, day TEXT, min_views INTEGER, max_views INTEGER,
+                                            last_views INTEGER, last_collect_id INTEGER, PRIMARY KEY (video_id, day));
+    CREATE TABLE IF NOT EXISTS channel_daily (channel_id INTEGER, day TEXT, min_subscribers INTEGER,
+                                              max_subscribers INTEGER, last_subscribers INTEGER,
+                                              last_collect_id INTEGER, PRIMARY KEY (channel_id, day));
+"""
+
+TABLES = [{'name': 'channel', 'fields': ['channel_id', 'yt_id', 'title', 'description', 'published_at', 'cluster'],
+           'primaryKey': 'channel_id'},
+          {'name': 'video', 'fields': ['video_id', 'yt_id', 'title', 'description', 'channel_id', 'length_seconds',
+                                       'published_at'], 'primaryKey': 'video_id'},
+          {'name': 'collect_channel', 'fields': ['collect_id', 'channel_id', 'subscriber_count', 'collected_at'],
+           'primaryKey': ['collect_id', 'channel_id']},
+          {'name': 'collect_video', 'fields': ['collect_id', 'video_id', 'like_count', 'dislike_count', 'view_count',
+                                               'comment_count', 'collected_at'],
+           'primaryKey': ['collect_id', 'video_id']}]
+
+
+class SQLiteDatabase():
+    conn = None
+    lock = Lock()
+    calls = {}  # Round trips per call
+    rollups = Database.rollups
+
+    @classmethod
+    def open(cls, path):
+        cls.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        cls.conn.row_factory = sqlite3.Row
+        cls.conn.execute('PRAGMA journal_mode = WAL')
+        cls.conn.executescript(SCHEMA)
+        cls.calls = {}
+
+    @classmethod
+    def count(cls, call):
+        cls.calls[call] = cls.calls.get(call, 0) + 1
+
+    @staticmethod
+    def translate(sql):  # MySQL quoting and placeholders to SQLite
+        return sql.replace('%s', '?').replace('"', "'").replace('BINARY ', '')
+
+    def select(self, table, *columns, where=None):
+        sql = 'SELECT {} FROM {} {}'.format(', '.join(columns or ['*']), table,
+                                            'WHERE {}'.format(' AND '.join(where)) if where else '')
+        with self.lock:
+            self.count('select')
+            return [dict(r) for r in self.conn.execute(self.translate(sql)).fetchall()]
+
+    def stream(self, sql, args=None):
+        with self.lock:
+            self.count('stream')
+            rows = self.conn.execute(self.translate(sql), args or ()).fetchall()
+        for r in rows:
+            yield dict(r)
+
+    pages = Database.pages
+
+    def insert(self, table, values):
+        rows = values if isinstance(values, list) else [values]
+        columns = list(rows[0].keys())
+        sql = 'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns), ', '.join(['?'] * len(columns)))
+        with self.lock:
+            self.count('insert')
+            if isinstance(values, list):
+                self.conn.executemany(sql, [[r[c] for c in columns] for r in rows])
+                return 0
+            return self.conn.execute(sql, [values[c] for c in columns]).lastrowid
+
+    def upsert(self, table, rows):
+        columns = list(rows[0].keys())
+        sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(table, ', '.join(columns),
+                                                                   ', '.join(['?'] * len(columns)))
+        with self.lock:
+            self.count('upsert')
+            self.conn.execute('BEGIN')
+            self.conn.executemany(sql, [[r[c] for c in columns] for r in rows])
+            self.conn.execute('COMMIT')
+
+    def load_data(self, table, rows):
+        self.upsert(table, rows)
+
+    def rollup(self, table, rows):
+        rollup, key, column, name = self.rollups[table]
+        sql = ('INSERT INTO {0} ({1}, day, min_{2}, max_{2}, last_{2}, last_collect_id) VALUES (?, ?, ?, ?, ?, ?) '
+               'ON CONFLICT ({1}, day) DO UPDATE SET min_{2} = MIN(min_{2}, excluded.min_{2}), '
+               'max_{2} = MAX(max_{2}, excluded.max_{2}), '
+               'last_{2} = CASE WHEN excluded.last_collect_id >= last_collect_id THEN excluded.last_{2} '
+               'ELSE last_{2} END, last_collect_id = MAX(last_collect_id, excluded.last_collect_id)').format(
+            rollup, key, name)
+        with self.lock:
+            self.count('rollup')
+            self.conn.execute('BEGIN')
+            self.conn.executemany(sql, Database.rollup_days(key, column, rows))
+            self.conn.execute('COMMIT')
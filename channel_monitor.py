@@ -1,12 +1,21 @@
+from argparse import ArgumentParser
 from configurable import Configurable
-from csv import DictReader
 from datetime import date, datetime, timedelta
-from isodate import parse_duration
-from itertools import groupby
 import logging
+import json
+from os import makedirs
+from os.path import exists
+import subprocess
+import sys
 from queue import Empty, Queue
-from threading import Lock, Thread, Semaphore, get_ident, current_thread
-from tools import APIRequest, Database
+from threading import Event, Lock, Thread, Semaphore, get_ident, current_thread
+from time import time
+from zlib import crc32
+from id_index import IdIndex
+from metrics import metrics
+from timeutils import format_timestamp, local_now, parse_duration, parse_timestamp
+from tools import (APIRequest, ChannelSource, Database, DatabaseWriter, KeyScheduler, RateLimiter, ResponseCache,
+                   StateStore, reserve_collect_id)
 
 
 class Monitor(Configurable):
@@ -19,51 +28,141 @@ class Monitor(Configurable):
 
     def parse_date(self, s,
                    return_datetime=False):  # Converts datetime string from API response to date/datetime object
-        d = datetime.strptime(s[:-1].split('.')[0], '%Y-%m-%dT%H:%M:%S') + timedelta(hours=self.config['api']['timezoneDifference'])
+        d = parse_timestamp(s, self.api_offset)
         if return_datetime:
             return d
         return d.date()
 
-    def __init__(self, from_file=False):
+    def __init__(self, from_file=False, engine='threads', resume=False, shard=None, collect_id=None):
         super().__init__(self)
 
-        with open(self.config['files']['collectIdFile'], 'r') as f:
-            self.collect_id = int(f.readline().strip())
+        # Timezone offsets of API timestamps and of the server clock, read once
+        self.api_offset = timedelta(hours=self.config['api']['timezoneDifference'])
+        self.server_offset = timedelta(hours=self.config['server']['timezoneDifference'])
         self.logger = self.create_log()
         self.logger.info('Log initialized.')
-        self.channel_ids = []
-        self.db_ids = self.get_ids()
-        self.db_queue = Queue()
-        self.db_thread = Thread(target=self.save_to_database,
-                                name='db_thread')
-        self.api_queue = Queue()
+        self.started_at = time()
+        metrics.reset()
+        self.shard = shard  # (i, n): only channels hashing to shard i of n are collected
+        self.state = StateStore(self.config['files'].get('stateFile', 'monitor_state.db'))
+        # The run is finished in the journal by the process that reserved its collect ID
+        self.owns_run = collect_id is None
+        self.collect_id = self.state.unfinished_run() if resume and collect_id is None else collect_id
+        completed = set()
+        if self.collect_id is None:
+            self.collect_id = reserve_collect_id(self.config['files']['collectIdFile'])
+            self.state.start_run(self.collect_id)
+        else:
+            self.state.start_run(self.collect_id)
+            completed = self.state.completed_channels(self.collect_id)
+            self.logger.info('Resuming collect {}: {} channels already completed.'.format(self.collect_id,
+                                                                                          len(completed)))
+        self.stats_lock = Lock()
+        self.stats = {'channels': 0, 'rows': {}}
+        self.ids = {'channel': self.load_index('channel', 24), 'video': self.load_index('video', 11)}
+        self.writer = DatabaseWriter(self.logger, on_saved=self.rows_saved, on_channels=self.channels_saved)
+        replayed = self.writer.replay()
+        if replayed:
+            self.logger.info('Replayed {} rows spilled by earlier runs.'.format(replayed))
+        self.api_queue = Queue(maxsize=self.config['files'].get('queueSize', 10000))
         self.api_semaphore = Semaphore()
+        quota = self.config['api'].get('quota') or {}
+        keys = self.config['api']['keys']
+        if shard and len(keys) >= shard[1]:
+            keys = keys[shard[0]::shard[1]]  # Each shard spends its own subset of keys
+        self.scheduler = KeyScheduler(keys, daily_quota=quota.get('daily', 10000),
+                                      state_file=self.config['files'].get('quotaFile'),
+                                      reset_timezone=quota.get('timezone', 'America/Los_Angeles'))
+        retry = self.config['api'].get('retry') or {}
+        rate = self.config['api'].get('rateLimit') or {}
+        self.limiter = RateLimiter(rate=rate.get('rate', 10), burst=rate.get('burst', 10),
+                                   min_rate=rate.get('minRate', 0.5), max_rate=rate.get('maxRate', 50),
+                                   attempts=retry.get('attempts', 5), base_delay=retry.get('baseDelay', 1),
+                                   max_delay=retry.get('maxDelay', 60))
+        cache = self.config['api'].get('cache') or {}
+        self.cache = None
+        if cache.get('file'):
+            self.cache = ResponseCache(cache['file'], ttl=cache.get('ttl'), max_entries=cache.get('maxEntries', 100000),
+                                       offline=cache.get('offline', False), record=cache.get('record', False),
+                                       missing_ttl=cache.get('missingTtl', 0))
         self.api_threads = [Thread(target=self.collect_info,
-                                   args=(self.config['api']['keys'][i % len(self.config['api']['keys'])],),
                                    name='api_thread_{}'.format(i)) for i in range(self.config['api']['threads'])]
 
-        self.now = (datetime.now() + timedelta(hours=self.config['server']['timezoneDifference'])).date()
+        self.now = (datetime.now() + self.server_offset).date()
         self.limit = timedelta(self.config['api']['videos']['dateLimit'])
 
-        if from_file:
-            with open(self.config['files']['listFile'], 'r', encoding=self.config['files']['encoding']) as f:
-                reader = DictReader(f)
-                headers = reader.fieldnames
-                for row in reader:
-                    self.api_queue.put(row['channel_id'])
+        # Channels are streamed into the bounded api_queue while the workers consume it
+        page = self.config['database'].get('pageSize', 5000)
+        self.source = ChannelSource() if from_file else Database().pages('channel', 'channel_id', ['yt_id'], page)
+        self.source_thread = Thread(target=self.feed_channels, args=(self.source, completed), name='source_thread',
+                                    daemon=True)
+        self.source_thread.start()
+
+        self.writer.start()
+        port = self.config['server'].get('metricsPort', 0)
+        if port:
+            port += shard[0] if shard else 0  # One port per shard on the same machine
+            metrics.serve(port)
+            self.logger.info('Serving metrics on http://127.0.0.1:{}/metrics'.format(port))
+        self.sampling = Event()
+        Thread(target=self.sample_queues, name='metrics_sampler', daemon=True).start()
+        if engine == 'async':
+            from async_engine import AsyncEngine  # aiohttp is only needed by the async engine
+            AsyncEngine(self).run()
         else:
-            for c in self.channel_ids:
-                self.api_queue.put(c)
-
-        self.db_thread.start()
-        for t in self.api_threads:
-            t.start()
-        self.db_thread.join()
-        for t in self.api_threads:
-            t.join()
+            for t in self.api_threads:
+                t.start()
+            for t in self.api_threads:
+                t.join()
+        self.writer.close()
+        self.sampling.set()
+        self.scheduler.save()
+        summary = self.scheduler.summary()
+        self.logger.info(summary)
+        print(summary)
+        self.logger.info('API retry counters: {}'.format(self.limiter.counters()))
+        if self.cache:
+            self.logger.info('Response cache counters: {}'.format(self.cache.counters()))
+        if not shard:
+            self.save_indexes()  # Shards share the mapped index files read-only
+        if self.owns_run:
+            self.state.finish_run(self.collect_id)
+        self.save_stats()
         self.logger.info('Finished execution.')
-        with open(self.config['files']['collectIdFile'], 'w') as f:
-            f.write(str(self.collect_id + 1))
+
+    def save_stats(self):  # Run statistics, merged by the coordinator of a sharded collect
+        stats = dict(self.stats, collect_id=self.collect_id, shard=list(self.shard) if self.shard else [0, 1],
+                     seconds=round(time() - self.started_at, 1),
+                     quota={'...' + k[-4:]: v for k, v in self.scheduler.run_spent.items()},
+                     calls=self.scheduler.run_calls, api=self.limiter.counters(),
+                     cache=self.cache.counters() if self.cache else {}, metrics=metrics.summary())
+        directory = self.config['files'].get('statsDirectory', 'stats')
+        makedirs(directory, exist_ok=True)
+        with open('{}/stats_{}_{}of{}.json'.format(directory, self.collect_id, *stats['shard']), 'w') as f:
+            f.write(json.dumps(stats, indent=4))
+
+    def sample_queues(self):  # Records the depth of the queues between stages until the run ends
+        interval = self.config['server'].get('metricsInterval', 5)
+        while True:
+            metrics.gauge('queue_depth', self.api_queue.qsize(), queue='api')
+            metrics.gauge('queue_depth', self.writer.qsize(), queue='db')
+            if self.sampling.wait(interval):
+                return
+
+    def feed_channels(self, source, completed):  # Blocks while api_queue is full
+        try:
+            for channel_id in source:
+                if isinstance(channel_id, dict):
+                    channel_id = channel_id['yt_id']
+                if self.shard and crc32(channel_id.encode()) % self.shard[1] != self.shard[0]:
+                    continue
+                if channel_id not in completed:
+                    self.api_queue.put(channel_id)
+                    metrics.count('channels_read')
+        except Exception as err:
+            self.logger.error('Failed to read channel list: {}'.format(repr(err)))
+        finally:
+            self.api_queue.put(None)  # End of the list. Each worker puts it back for the next one
 
     def create_log(self):
         logger = logging.getLogger('Monitor')
@@ -75,89 +174,165 @@ class Monitor(Configurable):
         logger.addHandler(fh)
         return logger
 
-    def get_ids(self):
+    def load_index(self, table, width):
+        # Loads the ID index saved by the last run and catches up with rows added since, or builds it from scratch
         db = Database()
-        results = {}
+        key = '{}_id'.format(table)
+        path = '{}/{}.idx'.format(self.config['files'].get('indexDirectory', '.'), table)
         try:
-            channel_ids = db.select('channel', *['channel_id', 'yt_id'])
-            self.channel_ids = [c['yt_id'] for c in channel_ids]
-            for c in channel_ids:
-                results[c['yt_id']] = c['channel_id']
-
-            video_ids = db.select('video', *['video_id', 'yt_id'])
-            for v in video_ids:
-                results[v['yt_id']] = v['video_id']
+            if exists(path):
+                index = IdIndex.load(path)
+                for row in db.stream('SELECT {0}, yt_id FROM {1} WHERE {0} > %s'.format(key, table), (index.max_id,)):
+                    index[row['yt_id']] = row[key]
+            else:
+                rows = db.stream('SELECT {}, yt_id FROM {} ORDER BY BINARY yt_id'.format(key, table))
+                index = IdIndex.build(width, ((row['yt_id'], row[key]) for row in rows))
+            self.logger.info('Loaded {} {} IDs.'.format(len(index), table))
         except Exception as err:
             self.logger.error('Failed to retrieve database IDs. {}'.format(repr(err)))
-        return results
+            index = IdIndex(width)
+            index.persistent = False  # Saving it would replace the file with the IDs of this run only
+        return index
 
-    def save_to_database(self):
-        db = Database()
-        query = None
-        buffer = []
-        empty = False
-        while not empty:
+    def save_indexes(self):
+        for table, index in self.ids.items():
+            if not index.persistent:
+                self.logger.info('Not saving the {} ID index, which failed to load.'.format(table))
+                continue
             try:
-                query = self.db_queue.get(timeout=240)
-            except Empty:
-                self.logger.warning('Database queue empty.')
-                empty = True
-            buffer.append(query)
-            if len(buffer) >= self.config['database']['bufferLimit'] or (empty and len(buffer) > 0):
-                buffer.sort(key=lambda k: k['table'])
-                for key, group in groupby(buffer, key=lambda k: k['table']):
-                    db_attempts = 3
-                    while db_attempts:
-                        try:
-                            db.insert(key, [g['columns'] for g in group])
-                            break
-                        except Exception as err:
-                            self.logger.error(
-                                'Failed to save to database: {} Attempting {} more times.'.format(repr(err),
-                                                                                                  db_attempts))
-                            db_attempts -= 1
-                buffer.clear()
+                index.save('{}/{}.idx'.format(self.config['files'].get('indexDirectory', '.'), table))
+            except Exception as err:
+                self.logger.error('Failed to save {} ID index. {}'.format(table, repr(err)))
+
+    def rows_saved(self, table, count):
+        metrics.count('rows_saved', count, table=table)
+        self.state.record_flush(self.collect_id, table, count)
+        with self.stats_lock:
+            self.stats['rows'][table] = self.stats['rows'].get(table, 0) + count
+
+    def channels_saved(self, channels):
+        self.state.complete_channels(self.collect_id, channels)
+
+    def channel_done(self, channel_id):
+        self.writer.put({'table': None, 'channel': channel_id})
+        metrics.count('channels_collected')
+        with self.stats_lock:
+            self.stats['channels'] += 1
+
+    def lookup_ids(self, db, table, yt_ids):  # Loads database IDs of a batch of YouTube IDs into the ID index
+        key = '{}_id'.format(table)
+        where = ['yt_id IN ({})'.format(', '.join('"{}"'.format(i) for i in yt_ids))]
+        for row in db.select(table, *[key, 'yt_id'], where=where):
+            self.ids[table][row['yt_id']] = row[key]
+
+    def video_rows(self, response, channel_dbid):  # Builds video rows from a snippet,contentDetails response
+        rows = []
+        for v in response.get('items', []):
+            try:
+                snippet = v['snippet']
+                rows.append({'yt_id': v['id'], 'title': snippet['title'],
+                             'description': snippet['description'], 'channel_id': channel_dbid,
+                             'length_seconds': parse_duration(v['contentDetails']['duration']),
+                             'published_at': format_timestamp(self.parse_date(snippet['publishedAt'],
+                                                                              return_datetime=True))})
+            except KeyError as err:
+                self.logger.error('KeyError while getting video info: {}'.format(repr(err)))
+        return rows
+
+    def fetch_videos(self, api, channel_dbid, video_ids):  # Fetches metadata of new videos, in batches of maxResults
+        rows = []
+        for r in self.chunks(video_ids, self.config['api']['videos']['maxResults']):
+            request, response = api.list('videos', **{'part': 'snippet,contentDetails', 'id': ','.join(r)})
+            rows.extend(self.video_rows(response, channel_dbid))
+        return rows
+
+    def channel_row(self, channel_id, snippet):
+        return {'yt_id': channel_id, 'title': snippet['title'], 'description': snippet['description'],
+                'published_at': format_timestamp(self.parse_date(snippet['publishedAt'], return_datetime=True))}
+
+    def page_videos(self, response, watermark=None):
+        # Returns (video ID, publish date) of the videos of a playlist page newer than the watermark and inside the
+        # date limit, and whether the scan can stop at this page
+        page = []
+        for v in response['items']:
+            video_id = v['contentDetails']['videoId']
+            published_at = self.parse_date(v['contentDetails']['videoPublishedAt'], return_datetime=True)
+            if self.now - published_at.date() > self.limit:
+                return page, True
+            published_at = format_timestamp(published_at)
+            if watermark and (video_id == watermark[1] or published_at < watermark[0]):
+                return page, True
+            page.append((video_id, published_at))
+        return page, False
+
+    def active_videos(self, db, channel_id, seen):  # Videos from earlier scans still inside the date limit
+        videos = [v for v in self.state.active_videos(channel_id, (self.now - self.limit).isoformat()) if v not in seen]
+        missing = [v for v in videos if v not in self.ids['video']]
+        if missing:
+            self.lookup_ids(db, 'video', missing)
+        return [v for v in videos if v in self.ids['video']]
+
+    def resolve_videos(self, api, db, channel_dbid, video_ids):
+        # Checks the ID index first, then looks up the remaining IDs with a single query and saves the missing ones at once
+        missing = [v for v in video_ids if v not in self.ids['video']]
+        if missing:
+            self.lookup_ids(db, 'video', missing)
+            missing = [v for v in missing if v not in self.ids['video']]
+        if missing:
+            rows = self.fetch_videos(api, channel_dbid, missing)
+            if rows:
+                db.insert('video', rows)
+                self.lookup_ids(db, 'video', [r['yt_id'] for r in rows])
+        return [v for v in video_ids if v in self.ids['video']]
+
+    def collected_at(self):
+        return local_now(self.server_offset)
+
+    def collect_channel_row(self, channel_id, response):
+        statistics = response['items'][0]['statistics']
+        query = {'table': 'collect_channel', 'channel': channel_id,
+                 'columns': {'collect_id': self.collect_id, 'channel_id': self.ids['channel'][channel_id]}}
+        query['columns']['subscriber_count'] = statistics['subscriberCount']
+        query['columns']['collected_at'] = self.collected_at()
+        return query
+
+    def collect_video_rows(self, channel_id, response):
+        rows = []
+        collected_at = self.collected_at()  # Shared by the whole batch
+        for v in response['items']:
+            statistics = v['statistics']
+            query = {'table': 'collect_video', 'channel': channel_id,
+                     'columns': {'collect_id': self.collect_id, 'video_id': self.ids['video'][v['id']]}}
+            query['columns']['like_count'] = statistics.get('likeCount', 0)
+            query['columns']['dislike_count'] = statistics.get('dislikeCount', 0)
+            query['columns']['view_count'] = statistics.get('viewCount', 0)
+            query['columns']['comment_count'] = statistics.get('commentCount', 0)
+            query['columns']['collected_at'] = collected_at
+            rows.append(query)
+        return rows
 
     def collect_channel(self, api, channel_id):
         request, response = api.list('channels', **{'part': 'statistics', 'id': channel_id})
-        try:
-            statistics = response['items'][0]['statistics']
-            query = {'table': 'collect_channel',
-                     'columns': {'collect_id': self.collect_id, 'channel_id': self.db_ids[channel_id]}}
-            query['columns']['subscriber_count'] = statistics['subscriberCount']
-            query['columns']['collected_at'] = (datetime.now() + timedelta(
-                hours=self.config['server']['timezoneDifference'])).strftime('%Y-%m-%d %H:%M:%S')
-            self.db_queue.put(query)
-        except KeyError as err:
-            raise err
-
-    def collect_videos(self, api, videos):
+        self.writer.put(self.collect_channel_row(channel_id, response))
+
+    def collect_videos(self, api, channel_id, videos):
         for r in self.chunks(videos):
             request, response = api.list('videos', **{'part': 'statistics', 'id': ','.join(r)})
-            try:
-                for v in response['items']:
-                    video_id = v['id']
-                    statistics = v['statistics']
-                    query = {'table': 'collect_video',
-                             'columns': {'collect_id': self.collect_id, 'video_id': self.db_ids[video_id]}}
-                    query['columns']['like_count'] = statistics.get('likeCount', 0)
-                    query['columns']['dislike_count'] = statistics.get('dislikeCount', 0)
-                    query['columns']['view_count'] = statistics.get('viewCount', 0)
-                    query['columns']['comment_count'] = statistics.get('commentCount', 0)
-                    query['columns']['collected_at'] = (datetime.now() + timedelta(
-                        hours=self.config['server']['timezoneDifference'])).strftime('%Y-%m-%d %H:%M:%S')
-                    self.db_queue.put(query)
-            except KeyError as err:
-                raise err
+            for query in self.collect_video_rows(channel_id, response):
+                self.writer.put(query)
 
-    def collect_info(self, key):
-        api = APIRequest(api_key=key)
+    def collect_info(self):
+        api = APIRequest(scheduler=self.scheduler, limiter=self.limiter, cache=self.cache)
         db = Database()
 
         queue_attempts = 3
+        busy_since = None
 
         # Gets channel from queue
         while queue_attempts:
+            if busy_since:
+                metrics.thread_time(time() - busy_since)  # Time spent on the last channel
+            waiting_since = time()
             try:
                 self.api_semaphore.acquire(blocking=True, timeout=120)
                 channel_id = self.api_queue.get(timeout=120)
@@ -168,9 +343,14 @@ class Monitor(Configurable):
                 continue
             finally:
                 self.api_semaphore.release()
+                busy_since = time()
+                metrics.thread_time(busy_since - waiting_since, busy=False)
+            if channel_id is None:
+                self.api_queue.put(None)
+                break
 
             # Checks if channel is already in database, otherwise saves it
-            channel_dbid = self.db_ids.get(channel_id, 0)
+            channel_dbid = self.ids['channel'].get(channel_id, 0)
             if not channel_dbid:
                 try:
                     db_id_query = db.select('channel', *['channel_id'], where=['yt_id LIKE "{}"'.format(channel_id)])
@@ -178,14 +358,9 @@ class Monitor(Configurable):
                     if not db_id_query:
                         request, response = api.list('channels', **{'part': 'snippet', 'id': channel_id})
                         try:
-                            snippet = response['items'][0]['snippet']
-                            channel_query = {'yt_id': channel_id, 'title': snippet['title'],
-                                             'description': snippet['description'],
-                                             'published_at': self.parse_date(snippet['publishedAt'],
-                                                                             return_datetime=True).strftime(
-                                                 '%Y-%m-%d %H:%M:%S')}
-                            channel_dbid = db.insert('channel', channel_query)
-                            self.db_ids[channel_id] = channel_dbid
+                            channel_dbid = db.insert('channel', self.channel_row(channel_id,
+                                                                                 response['items'][0]['snippet']))
+                            self.ids['channel'][channel_id] = channel_dbid
                         except KeyError as err:
                             self.logger.error('KeyError while getting channel info: {}'.format(repr(err)))
                             continue
@@ -194,114 +369,137 @@ class Monitor(Configurable):
                             continue
                     else:
                         channel_dbid = db_id_query[0]['channel_id']
-                        self.db_ids[channel_id] = channel_dbid
+                        self.ids['channel'][channel_id] = channel_dbid
                 except Exception as err:
                     self.logger.error(repr(err))
                     continue
 
-            # Collects channel, attempting 3 times
-            collect_attempts = 3
-            while collect_attempts:
-                try:
-                    self.collect_channel(api, channel_id)
-                    break
-                except Exception as err:
-                    collect_attempts -= 1
-                    self.logger.error(
-                        'Failed to collect channel {}: {} Attempting {} more times.'.format(channel_id, repr(err),
-                                                                                            collect_attempts))
-            if not collect_attempts:
-                self.logger.info('Could not collect channel: {}'.format(channel_id))
+            # Collects channel. Retries and rate limiting are handled by APIRequest
+            try:
+                self.collect_channel(api, channel_id)
+            except Exception as err:
+                self.logger.error('Could not collect channel {}: {}'.format(channel_id, repr(err)))
                 continue
 
             # Retrieves recent videos
             playlist_id = 'UU' + channel_id[2:]  # Playlist ID of channel c's uploads, can be derived from channel ID
-            fetch_attempts = 3
-            request, response = None, None
-            while fetch_attempts:
+            try:
+                request, response = api.list('playlistItems',
+                                             **{'part': 'contentDetails', 'playlistId': playlist_id, 'maxResults': 50})
+            except Exception as err:
+                self.logger.error('Failed to get videos for channel {}: {}'.format(channel_id, repr(err)))
+                continue
+            # Only pages newer than the channel's watermark are scanned
+            watermark = self.state.watermark(channel_id)
+            new_videos = []
+            done = False
+            complete = True  # Every playlist page was scanned
+            collected = True  # Stats of every video found were collected
+            while request and not done:
+                page, done = self.page_videos(response, watermark)
+                video_list = []
                 try:
-                    request, response = api.list('playlistItems',
-                                                 **{'part': 'contentDetails', 'playlistId': playlist_id,
-                                                    'maxResults': 50})
-                    break
+                    video_list = self.resolve_videos(api, db, channel_dbid, [v for v, p in page])
+                    new_videos.extend(page)
                 except Exception as err:
-                    fetch_attempts -= 1
-                    self.logger.error(
-                        'Error while getting videos for channel {}: {} Attempting {} more times.'.format(channel_id,
-                                                                                                         repr(err),
-                                                                                                         fetch_attempts))
-            if not fetch_attempts:
-                self.logger.error('Failed to get videos for {}'.format(channel_id))
-                continue
-            video_list = []
-            limit_reached = False
-            while request and not limit_reached:
-                for v in response['items']:
-                    video_id = v['contentDetails']['videoId']
-                    published_at = self.parse_date(v['contentDetails']['videoPublishedAt'])
-                    if self.now - published_at > self.limit:
-                        limit_reached = True
-                        break
+                    complete = False
+                    self.logger.error('Error while getting video data: {}'.format(repr(err)))
+                try:
+                    self.collect_videos(api, channel_id, video_list)
+                except Exception as err:
+                    collected = False
+                    self.logger.error('Could not collect videos from channel {}: {}'.format(channel_id, repr(err)))
+
+                if not done:
                     try:
-                        db_id_query = \
-                            db.select('video', 'video_id', where=['yt_id LIKE "{}"'.format(video_id)])
-                        if not db_id_query:
-                            request, response = api.list('videos', **{'part': 'snippet,contentDetails', 'id': video_id})
-                            try:
-                                snippet = response['items'][0]['snippet']
-                                content_details = response['items'][0]['contentDetails']
-                                video_query = {'yt_id': video_id, 'title': snippet['title'],
-                                               'description': snippet['description'], 'channel_id': channel_dbid,
-                                               'length_seconds': int(
-                                                   parse_duration(content_details['duration']).total_seconds()),
-                                               'published_at': self.parse_date(snippet['publishedAt'],
-                                                                               return_datetime=True).strftime(
-                                                   '%Y-%m-%d %H:%M:%S')}
-                                video_dbid = db.insert('video', video_query)
-                                self.db_ids[video_id] = video_dbid
-                            except KeyError as err:
-                                self.logger.error('KeyError while getting video info: {}'.format(repr(err)))
-                                continue
-                        else:
-                            video_dbid = db_id_query[0]['video_id']
-                            self.db_ids[video_id] = video_dbid
+                        request, response = api.list_next('playlistItems', request, response)
                     except Exception as err:
-                        self.logger.error('Error while getting video data: {}'.format(repr(err)))
-                        continue
-                    video_list.append(video_id)
-                collect_attempts = 3
-                while collect_attempts:
-                    try:
-                        self.collect_videos(api, video_list)
-                        break
-                    except Exception as err:
-                        collect_attempts -= 1
-                        self.logger.error(
-                            'Failed to collect videos from channel {}: '
-                            '{} Attempting {} more times.'.format(channel_id,
-                                                                  repr(err),
-                                                                  collect_attempts))
-                    finally:
-                        video_list.clear()
-                if not collect_attempts:
-                    self.logger.info('Could not collect videos from channel: {}'.format(channel_id))
-
-                if not limit_reached:
-                    execute_attempts = 3
-                    while execute_attempts:
-                        try:
-                            request, response = api.list_next('playlistItems', request, response)
-                            break
-                        except Exception as err:
-                            execute_attempts -= 1
-                            self.logger.error(
-                                'Video fetch response error: {} Attempting {} more time(s)'.format(' '.join(err.args),
-                                                                                                   execute_attempts))
-                            continue
-                    if not execute_attempts:
+                        complete = False
+                        self.logger.error('Video fetch response error for channel {}: {}'.format(channel_id,
+                                                                                              repr(err)))
                         break
+
+            # Videos found by earlier scans are refreshed without going through the playlist again
+            try:
+                active = self.active_videos(db, channel_id, set(v for v, p in new_videos))
+                self.collect_videos(api, channel_id, active)
+            except Exception as err:
+                collected = False
+                self.logger.error('Could not collect active videos from channel {}: {}'.format(channel_id, repr(err)))
+            self.state.update_channel(channel_id, new_videos, (self.now - self.limit).isoformat(),
+                                      advance_watermark=complete)
+            if complete and collected:  # Otherwise the channel is collected again by --resume
+                self.channel_done(channel_id)
             queue_attempts = 3
         self.logger.info('Finished execution for Thread {}'.format(get_ident()))
 
 
-Monitor()
+class Coordinator(Configurable):
+    # Runs a collect as N shard processes sharing one collect ID, then merges their run statistics
+
+    def __init__(self, shards, args):
+        super().__init__(fields=['files'])
+        state = StateStore(self.config['files'].get('stateFile', 'monitor_state.db'))
+        collect_id = state.unfinished_run() if args.resume else None
+        if collect_id is None:
+            collect_id = reserve_collect_id(self.config['files']['collectIdFile'])
+            state.start_run(collect_id)
+        command = [sys.executable, sys.argv[0], '--engine', args.engine, '--collect-id', str(collect_id)]
+        if args.from_file:
+            command.append('--from-file')
+        processes = [subprocess.Popen(command + ['--shard', '{}/{}'.format(i, shards)]) for i in range(shards)]
+        failed = [i for i, p in enumerate(processes) if p.wait() != 0]
+        if failed:
+            print('Shards {} failed. Run again with --shards {} --resume to finish collect {}.'.format(
+                failed, shards, collect_id))
+        else:
+            state.finish_run(collect_id)
+        print(json.dumps(self.merge_stats(collect_id, shards), indent=4))
+
+    def merge_stats(self, collect_id, shards):
+        merged = {'collect_id': collect_id, 'shards': 0, 'channels': 0, 'seconds': 0, 'rows': {}, 'quota': {},
+                  'calls': {}, 'api': {}, 'cache': {}}
+        for i in range(shards):
+            path = '{}/stats_{}_{}of{}.json'.format(self.config['files'].get('statsDirectory', 'stats'), collect_id,
+                                                    i, shards)
+            if not exists(path):
+                continue
+            with open(path, 'r') as f:
+                stats = json.loads(f.read())
+            merged['shards'] += 1
+            merged['channels'] += stats['channels']
+            merged['seconds'] = max(merged['seconds'], stats['seconds'])  # Shards run side by side
+            for field in ('rows', 'quota', 'calls', 'api', 'cache'):
+                for k, v in stats.get(field, {}).items():
+                    if isinstance(v, (int, float)):
+                        merged[field][k] = merged[field].get(k, 0) + v
+        return merged
+
+
+def shard_arg(value):
+    i, n = (int(v) for v in value.split('/'))
+    if not 0 <= i < n:
+        raise ValueError(value)
+    return i, n
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Collects channel and video statistics from the YouTube Data API.')
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                        help='threads: one API client per thread (default). async: single asyncio event loop.')
+    parser.add_argument('--from-file', action='store_true',
+                        help='Reads the channels from files.listFile instead of the channel table.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continues the last unfinished collect, skipping channels already saved.')
+    parser.add_argument('--shard', type=shard_arg, metavar='I/N',
+                        help='Collects only the channels of shard I out of N, with every Nth API key.')
+    parser.add_argument('--shards', type=int, metavar='N',
+                        help='Runs the collect as N shard processes and merges their statistics.')
+    parser.add_argument('--collect-id', type=int,
+                        help='Collect ID shared by the shards of a collect, instead of reserving a new one.')
+    args = parser.parse_args()
+    if args.shards:
+        Coordinator(args.shards, args)
+    else:
+        Monitor(from_file=args.from_file, engine=args.engine, resume=args.resume, shard=args.shard,
+                collect_id=args.collect_id)
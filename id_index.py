@@ -0,0 +1,155 @@
+from array import array
+import mmap
+from os import replace
+import struct
+from threading import Lock
+
+HEADER = struct.Struct('<4sIQQ')  # Magic, key width, number of keys, highest database ID
+MAGIC = b'YTIX'
+
+
+class IdIndex():
+    # Maps fixed-width YouTube IDs (11 bytes for videos, 24 for channels) to database IDs. Keys are packed in a
+    # sorted byte string searched by bisection, with values in a parallel int64 array. IDs added while running go
+    # to a small dict until the index is saved
+
+    def __init__(self, width, keys=b'', values=None, max_id=0, offset=0):
+        self.width = width
+        self.keys = keys  # bytes, or the mapped file with the keys starting at offset
+        self.offset = offset
+        self.values = values if values is not None else array('q')
+        self.max_id = max_id
+        self.added = {}
+        self.lock = Lock()
+        self.file = None
+        self.path = None  # File the index was loaded from
+        self.persistent = True  # False for an index standing in for one that failed to load, never saved
+
+    def __len__(self):
+        return len(self.values) + len(self.added)
+
+    def __contains__(self, yt_id):
+        return self.get(yt_id) is not None
+
+    def __getitem__(self, yt_id):
+        value = self.get(yt_id)
+        if value is None:
+            raise KeyError(yt_id)
+        return value
+
+    def __setitem__(self, yt_id, value):
+        with self.lock:
+            self.added[yt_id] = value
+            self.max_id = max(self.max_id, value)
+
+    def key(self, i):
+        start = self.offset + i * self.width
+        return self.keys[start:start + self.width]
+
+    def position(self, key):  # Position of the first packed key not lower than key
+        lo, hi = 0, len(self.values)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, key):  # Position of key in the packed keys, or -1
+        i = self.position(key)
+        return i if i < len(self.values) and self.key(i) == key else -1
+
+    def get(self, yt_id, default=None):
+        value = self.added.get(yt_id)
+        if value is not None:
+            return value
+        try:
+            key = yt_id.encode('ascii')
+        except UnicodeEncodeError:
+            return default
+        if len(key) != self.width:
+            return default
+        i = self.find(key)
+        return self.values[i] if i >= 0 else default
+
+    @classmethod
+    def build(cls, width, rows):  # rows: (yt_id, database ID) pairs, ideally in binary yt_id order
+        keys, values = bytearray(), array('q')
+        added = {}
+        last = b''
+        ordered = True
+        for yt_id, value in rows:
+            key = yt_id.encode('ascii', 'ignore')
+            if len(key) != width or len(yt_id) != width:
+                added[yt_id] = value  # Malformed IDs are kept, but not packed
+                continue
+            ordered = ordered and key > last
+            last = key
+            keys += key
+            values.append(value)
+        index = cls(width)
+        if not ordered:
+            order = sorted(range(len(values)), key=lambda i: keys[i * width:i * width + width])
+            keys = b''.join(keys[i * width:i * width + width] for i in order)
+            values = array('q', (values[i] for i in order))
+        index.keys, index.values = bytes(keys), values
+        index.max_id = max(max(values, default=0), max(added.values(), default=0))
+        index.added = added
+        return index
+
+    @classmethod
+    def load(cls, path):  # Maps the file read-only, so processes loading the same file share its pages
+        f = open(path, 'rb')
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, width, count, max_id = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise Exception('(id_index.py) {} is not an ID index file.'.format(path))
+        keys_end = HEADER.size + width * count
+        values_start = keys_end + (-keys_end % 8)
+        index = cls(width, keys=mm, max_id=max_id, offset=HEADER.size)
+        index.values = memoryview(mm)[values_start:values_start + 8 * count].cast('q')
+        index.file = (f, mm)
+        index.path = path
+        return index
+
+    def save(self, path):
+        # Merges the added IDs into the packed arrays and writes them atomically. The packed keys and values between
+        # two added IDs are copied as one slice
+        w = self.width
+        n = len(self.values)
+        with self.lock:
+            added = []  # (position, key, value)
+            for yt_id, value in sorted(self.added.items()):
+                if not yt_id.isascii() or len(yt_id) != w:
+                    continue  # Malformed IDs are not packed
+                key = yt_id.encode('ascii')
+                i = self.position(key)
+                if i == n or self.key(i) != key:
+                    added.append((i, key, value))
+            if not added and path == self.path:
+                return  # The file already holds every ID
+            count = n + len(added)
+            with open(path + '.tmp', 'wb') as f, memoryview(self.keys) as keys:
+                f.write(HEADER.pack(MAGIC, w, count, self.max_id))
+                start = 0
+                for i, key, value in added:
+                    f.write(keys[self.offset + start * w:self.offset + i * w])
+                    f.write(key)
+                    start = i
+                f.write(keys[self.offset + start * w:self.offset + n * w])
+                f.write(b'\0' * ((-(HEADER.size + w * count)) % 8))
+                start = 0
+                for i, key, value in added:
+                    f.write(self.values[start:i])
+                    f.write(array('q', [value]))
+                    start = i
+                f.write(self.values[start:n])
+        replace(path + '.tmp', path)
+
+    def close(self):
+        if self.file:
+            self.values.release()
+            self.file[1].close()
+            self.file[0].close()
+            self.file = None
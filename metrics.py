@@ -0,0 +1,155 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, current_thread
+from time import monotonic
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Upper bounds of latencies, in seconds
+
+
+class Metrics():
+    # Counters, gauges, latency histograms and thread busy/idle time shared by every thread of a process. Series are
+    # keyed by name and labels, as in the Prometheus text format
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):  # Starts measuring a new run
+        self.started = monotonic()
+        self.counters = {}
+        self.gauges = {}  # (name, labels): [last value, maximum]
+        self.histograms = {}  # (name, labels): [count per bucket (the last one for larger values), sum]
+        self.threads = {}  # Thread name: [busy seconds, idle seconds]
+
+    @staticmethod
+    def series(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, value=1, **labels):
+        key = self.series(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        key = self.series(name, labels)
+        with self.lock:
+            last = self.gauges.setdefault(key, [value, value])
+            last[0], last[1] = value, max(last[1], value)
+
+    def observe(self, name, seconds, **labels):
+        key = self.series(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * (len(BUCKETS) + 1), 0.0])
+            histogram[0][bisect_left(BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):  # Observes the time spent in the block, failed or not
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def thread_time(self, seconds, busy=True):  # Adds busy (working) or idle (waiting for work) time to the thread
+        name = current_thread().name
+        with self.lock:
+            times = self.threads.setdefault(name, [0.0, 0.0])
+            times[0 if busy else 1] += seconds
+
+    @staticmethod
+    def quantile(counts, q):  # Upper bound of the bucket holding the q quantile
+        total = sum(counts)
+        seen = 0
+        for i, c in enumerate(counts):
+            seen += c
+            if total and seen >= q * total:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return 0
+
+    @staticmethod
+    def label_name(name, labels):
+        return name + ''.join('[{}]'.format(v) for k, v in labels)
+
+    def summary(self):  # Plain dict of every series, with rates per second and latency percentiles
+        elapsed = monotonic() - self.started
+        with self.lock:
+            summary = {'seconds': round(elapsed, 1), 'counters': {}, 'gauges': {}, 'latency': {}, 'threads': {}}
+            for (name, labels), value in sorted(self.counters.items()):
+                summary['counters'][self.label_name(name, labels)] = {
+                    'total': value, 'per_second': round(value / elapsed, 2) if elapsed else 0}
+            for (name, labels), (last, peak) in sorted(self.gauges.items()):
+                summary['gauges'][self.label_name(name, labels)] = {'last': last, 'max': peak}
+            for (name, labels), (counts, total) in sorted(self.histograms.items()):
+                n = sum(counts)
+                summary['latency'][self.label_name(name, labels)] = {
+                    'count': n, 'mean': round(total / n, 4) if n else 0, 'p50': self.quantile(counts, 0.5),
+                    'p95': self.quantile(counts, 0.95), 'p99': self.quantile(counts, 0.99)}
+            for name, (busy, idle) in sorted(self.threads.items()):
+                summary['threads'][name] = {'busy': round(busy, 3), 'idle': round(idle, 3),
+                                            'utilization': round(busy / (busy + idle), 3) if busy + idle else 0}
+        return summary
+
+    @staticmethod
+    def labels_text(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+    def prometheus(self):  # Every series in the Prometheus text exposition format
+        lines = []
+        types = set()
+
+        def declare(name, kind):
+            if name not in types:
+                types.add(name)
+                lines.append('# TYPE ytmonitor_{} {}'.format(name, kind))
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                declare(name + '_total', 'counter')
+                lines.append('ytmonitor_{}_total{} {}'.format(name, self.labels_text(labels), value))
+            for (name, labels), (last, peak) in sorted(self.gauges.items()):
+                declare(name, 'gauge')
+                lines.append('ytmonitor_{}{} {}'.format(name, self.labels_text(labels), last))
+            for (name, labels), (counts, total) in sorted(self.histograms.items()):
+                declare(name, 'histogram')
+                seen = 0
+                for bound, c in zip(list(BUCKETS) + ['+Inf'], counts):
+                    seen += c
+                    lines.append('ytmonitor_{}_bucket{} {}'.format(name, self.labels_text(labels, [('le', bound)]),
+                                                                   seen))
+                lines.append('ytmonitor_{}_sum{} {}'.format(name, self.labels_text(labels), round(total, 6)))
+                lines.append('ytmonitor_{}_count{} {}'.format(name, self.labels_text(labels), seen))
+            for i, kind in enumerate(('busy', 'idle')):
+                declare('thread_{}_seconds'.format(kind), 'counter')
+                for name, times in sorted(self.threads.items()):
+                    lines.append('ytmonitor_thread_{}_seconds{} {}'.format(kind, self.labels_text([('thread', name)]),
+                                                                           round(times[i], 3)))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):  # Serves the Prometheus text on http://host:port/metrics
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                found = self.path.split('?')[0] == '/metrics'
+                body = metrics.prometheus().encode() if found else b''
+                self.send_response(200 if found else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, name='metrics_server', daemon=True).start()
+        return server
+
+
+metrics = Metrics()
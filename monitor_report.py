@@ -1,14 +1,31 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from configurable import Configurable
+from contextlib import ExitStack
 from tools import Database, APIRequest
-import pymysql
-from pymysql import cursors
 from csv import DictWriter, QUOTE_MINIMAL
 from datetime import datetime
+from heapq import heappush, heappushpop
+from itertools import count, repeat
+from os import remove
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Spacer
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4, letter, landscape, A3
 from reportlab.lib.units import inch, cm
-from sys import argv
+
+
+def render_pdf(path, tables_data, header, size=landscape(A3)):  # Module level, so worker processes can run it
+    pdf = SimpleDocTemplate(path, pagesize=size)
+    pdf_elements = []
+    for t in tables_data:
+        table = Table([header] + t)
+        table.setStyle(TableStyle([
+            ('INNERGRID', (0, 0), (-1, -1), 0.25, colors.black),
+            ('BOX', (0, 0), (-1, -1), 1, colors.black)
+        ]))
+        pdf_elements.append(table)
+        pdf_elements.append(Spacer(1, 0.25 * cm))
+    pdf.build(pdf_elements)
 
 
 class PDFManager(Configurable):
@@ -16,82 +33,143 @@ class PDFManager(Configurable):
     def __init__(self):
         super().__init__(self)
 
-    def save_pdf(self, filename, tables_data, header, size=landscape(A3)):
-        pdf = SimpleDocTemplate('reports/{}.pdf'.format(filename), pagesize=size)
-        pdf_elements = []
-        for t in tables_data:
-            data = t
-            data.insert(0, header)
-            table = Table(t)
-            table.setStyle(TableStyle([
-                ('INNERGRID', (0, 0), (-1, -1), 0.25, colors.black),
-                ('BOX', (0, 0), (-1, -1), 1, colors.black)
-            ]))
-            pdf_elements.append(table)
-            pdf_elements.append(Spacer(1, 0.25 * cm))
-        pdf.build(pdf_elements)
+    def save_pdf(self, filename, tables_data, header, size=landscape(A3), workers=None):
+        # Each table is rendered by its own process, then the pages are merged in order
+        path = 'reports/{}.pdf'.format(filename)
+        if len(tables_data) < 2 or workers == 1:
+            render_pdf(path, tables_data, header, size)
+            return
+        from pypdf import PdfWriter  # Only needed to merge tables rendered in parallel
+        parts = ['reports/.{}_{}.pdf'.format(filename, i) for i in range(len(tables_data))]
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(render_pdf, parts, [[t] for t in tables_data], repeat(header), repeat(size)))
+            writer = PdfWriter()
+            for part in parts:
+                writer.append(part)
+            with open(path, 'wb') as f:
+                writer.write(f)
+        finally:
+            for part in parts:
+                try:
+                    remove(part)
+                except OSError:
+                    pass
 
 
 class Report(Configurable):
 
-    def __init__(self, days=7, limit_per_table=20, save_pdf=False):
+    # Rows are not sorted by the database: the report keeps the top rows of each cluster in bounded heaps instead
+    query = """
+        SELECT v.title AS video_title, v.yt_id AS video_yt_id, COALESCE(cv.view_count, 0) AS view_count,
+               COALESCE(cv.view_delta, 0) AS view_delta, c.title AS channel_name, c.yt_id AS channel_yt_id,
+               v.published_at AS published_at, c.cluster AS channel_cluster
+        FROM video v
+        JOIN channel c ON v.channel_id = c.channel_id
+        LEFT JOIN (SELECT video_id, MAX(view_count) AS view_count, MAX(view_count) - MIN(view_count) AS view_delta
+                   FROM collect_video
+                   WHERE collect_id > %(collect_id)s GROUP BY video_id) cv ON cv.video_id = v.video_id
+        WHERE v.published_at >= DATE(NOW()) - INTERVAL %(days)s DAY
+    """
+
+    # Same report from the daily rollup kept by the monitor (database.rollups, see rollups.sql), which reads one row
+    # per video and day no matter how many collects were made
+    rollup_query = """
+        SELECT v.title AS video_title, v.yt_id AS video_yt_id, COALESCE(d.view_count, 0) AS view_count,
+               COALESCE(d.view_delta, 0) AS view_delta, c.title AS channel_name, c.yt_id AS channel_yt_id,
+               v.published_at AS published_at, c.cluster AS channel_cluster
+        FROM video v
+        JOIN channel c ON v.channel_id = c.channel_id
+        LEFT JOIN (SELECT video_id, MAX(max_views) AS view_count, MAX(max_views) - MIN(min_views) AS view_delta
+                   FROM video_daily
+                   WHERE day >= DATE(NOW()) - INTERVAL %(days)s DAY GROUP BY video_id) d ON d.video_id = v.video_id
+        WHERE v.published_at >= DATE(NOW()) - INTERVAL %(days)s DAY
+    """
+
+    fields = ['video_title', 'video_yt_id', 'view_count', 'channel_name', 'channel_yt_id', 'published_at',
+              'channel_cluster', 'view_delta']  # New columns go last, so readers by position keep working
+
+    def __init__(self, days=7, limit_per_table=20, save_pdf=False, formats=None, workers=None):
         super().__init__(self)
         self.days = int(days)
-        self.data = self.get_data()
-        self.get_views(self.data)
-        self.results = sorted(self.data, key = lambda i: i['view_count'], reverse=True)
-        fields = ['video_title', 'video_yt_id', 'view_count' , 'channel_name', 'channel_yt_id', 'published_at', 'channel_cluster']
+        formats = formats or (['csv', 'pdf'] if save_pdf else ['csv'])
+        pdf_fields = [f for f in self.fields if f not in ('channel_cluster', 'channel_yt_id')]
         filename = 'report_{}'.format(datetime.now().date())
-        with open('reports/{}.csv'.format(filename), 'w', encoding='utf8') as f:
-            w = DictWriter(f, delimiter=',', quotechar='"', quoting= QUOTE_MINIMAL, fieldnames=fields, lineterminator='\n', extrasaction='ignore')
-            w.writeheader()
-            w.writerows(self.results)
-
-        if save_pdf:
-            fields.remove('channel_cluster')
-            fields.remove('channel_yt_id')
+        top = {}  # Heap of the limit_per_table rows with most views of each cluster
+        order = count()  # Breaks ties between equal view counts
+        with ExitStack() as stack:
+            writers = []
+            if 'csv' in formats:
+                f = stack.enter_context(open('reports/{}.csv'.format(filename), 'w', encoding='utf8'))
+                w = DictWriter(f, delimiter=',', quotechar='"', quoting=QUOTE_MINIMAL, fieldnames=self.fields,
+                               lineterminator='\n', extrasaction='ignore')
+                w.writeheader()
+                writers.append(w.writerow)
+            if 'parquet' in formats:
+                writers.append(stack.enter_context(self.parquet_writer('reports/{}.parquet'.format(filename))))
+            for row in self.get_rows():
+                for write in writers:
+                    write(row)
+                if 'pdf' in formats and row['channel_cluster'] is not None:
+                    heap = top.setdefault(row['channel_cluster'], [])
+                    item = (int(row['view_count'] or 0), -next(order), [row[k] for k in pdf_fields])
+                    if len(heap) < limit_per_table:
+                        heappush(heap, item)
+                    elif item > heap[0]:
+                        heappushpop(heap, item)
+
+        if 'pdf' in formats:
             self.pdf = PDFManager()
-            clusters = {}
-            data_per_cluster = {}
-            for row in self.results:
-                if row['channel_cluster'] is None:
-                    continue
-                current_cluster = clusters.get(row['channel_cluster'],0)
-                if current_cluster < limit_per_table:
-                    clusters[row['channel_cluster']] = clusters.get(row['channel_cluster'], 0) + 1
-                    data_per_cluster[row['channel_cluster']] = data_per_cluster.get(row['channel_cluster'], [])
-                    pdf_row = {k: row[k] for k in fields if k in row}
-                    data_per_cluster[row['channel_cluster']].append([v for k, v in pdf_row.items()])
-            self.pdf.save_pdf(filename, [v for k, v in data_per_cluster.items()], fields)
-
-
-
-    def get_views(self, videos):
-        d = Database()
-        with open('.COLLECT') as f:
+            tables = [[r for v, n, r in sorted(top[k], reverse=True)] for k in sorted(top)]
+            self.pdf.save_pdf(filename, tables, pdf_fields, workers=workers)
+
+    def parquet_writer(self, path, batch=10000):  # Context manager returning a function that writes a row
+        import pyarrow as pa  # Only needed for the parquet format
+        import pyarrow.parquet as pq
+        schema = pa.schema([('video_title', pa.string()), ('video_yt_id', pa.string()), ('view_count', pa.int64()),
+                            ('channel_name', pa.string()), ('channel_yt_id', pa.string()),
+                            ('published_at', pa.timestamp('s')), ('channel_cluster', pa.string()),
+                            ('view_delta', pa.int64())])
+        columns = {f: [] for f in self.fields}
+        writer = pq.ParquetWriter(path, schema)
+
+        def flush():
+            if columns['video_yt_id']:
+                writer.write_table(pa.Table.from_pydict(columns, schema=schema))  # One row group per batch
+                for values in columns.values():
+                    values.clear()
+
+        def write(row):
+            for f in self.fields:
+                value = row[f]
+                columns[f].append(int(value or 0) if f in ('view_count', 'view_delta') else value)
+            if len(columns['video_yt_id']) >= batch:
+                flush()
+
+        class Writer():
+            def __enter__(self):
+                return write
+
+            def __exit__(self, *exc):
+                flush()
+                writer.close()
+
+        return Writer()
+
+    def get_rows(self):  # Streams report rows, aggregated by the database. They are ranked as they arrive, unsorted
+        if self.config['database'].get('rollups'):
+            return Database().stream(self.rollup_query, {'days': self.days})
+        with open(self.config['files']['collectIdFile']) as f:
             collect_id = int(f.readline().strip())
-        views = d.select('collect_video', *['video_id','MAX(view_count) as view_count'],where=['COLLECT_id > {} GROUP BY video_id'.format(collect_id - self.days - 10)])
-        for v in videos:
-            try:
-                v['view_count'] = next(item for item in views if item['video_id'] == v['video_id'])['view_count']
-            except StopIteration as e:
-                print('Error with video {}:\n{}\n\n'.format(v, repr(e)))
-                v['view_count'] = 0
-
-    def get_data(self):
-        results = []
-        conn = pymysql.connect(**self.config['database']['connection'])
-        try:
-            with conn.cursor(cursors.DictCursor) as cursor:
-                sql = 'SELECT v.video_id, v.yt_id as video_yt_id, v.title as video_title, v.published_at as published_at, c.yt_id as channel_yt_id, c.title as channel_name, c.cluster as channel_cluster from video v JOIN channel c ON v.channel_id = c.channel_id AND v.published_at >= DATE(NOW()) - INTERVAL {} DAY'.format(self.days)
-                cursor.execute(sql)
-                results = cursor.fetchall()
-        except pymysql.MySQLError as err:
-            print(err)
-        finally:
-            conn.close()
-            return results
+        return Database().stream(self.query, {'collect_id': collect_id - self.days - 10, 'days': self.days})
 
 
-days = int(argv[1]) if len(argv) > 1 else 7
-Report(days=days)
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Reports the most viewed videos published in the last days.')
+    parser.add_argument('days', type=int, nargs='?', default=7)
+    parser.add_argument('--format', choices=['csv', 'pdf', 'parquet'], nargs='+', default=['csv'], dest='formats',
+                        help='Files to write to the reports directory (default: csv).')
+    parser.add_argument('--limit', type=int, default=20, help='Videos of each cluster in the PDF.')
+    parser.add_argument('--workers', type=int, help='Processes rendering the PDF (default: one per core).')
+    args = parser.parse_args()
+    Report(days=args.days, limit_per_table=args.limit, formats=args.formats, workers=args.workers)
@@ -0,0 +1,48 @@
+-- Daily rollups of collect_video and collect_channel, kept up to date by the monitor's writers when
+-- database.rollups is enabled. Each row holds the lowest, highest and latest (by collect ID) value of a day, so
+-- reports read one row per video and day instead of every collect.
+
+CREATE TABLE IF NOT EXISTS video_daily (
+    video_id INT NOT NULL,
+    day DATE NOT NULL,
+    min_views BIGINT NOT NULL,
+    max_views BIGINT NOT NULL,
+    last_views BIGINT NOT NULL,
+    last_collect_id INT NOT NULL,
+    PRIMARY KEY (video_id, day),
+    KEY video_daily_day (day)
+);
+
+CREATE TABLE IF NOT EXISTS channel_daily (
+    channel_id INT NOT NULL,
+    day DATE NOT NULL,
+    min_subscribers BIGINT NOT NULL,
+    max_subscribers BIGINT NOT NULL,
+    last_subscribers BIGINT NOT NULL,
+    last_collect_id INT NOT NULL,
+    PRIMARY KEY (channel_id, day),
+    KEY channel_daily_day (day)
+);
+
+-- Backfills the rollups from the collects saved before they were enabled. Safe to run again.
+
+INSERT INTO video_daily (video_id, day, min_views, max_views, last_views, last_collect_id)
+SELECT cv.video_id, DATE(cv.collected_at), MIN(cv.view_count), MAX(cv.view_count),
+       SUBSTRING_INDEX(GROUP_CONCAT(cv.view_count ORDER BY cv.collect_id DESC), ',', 1), MAX(cv.collect_id)
+FROM collect_video cv
+GROUP BY cv.video_id, DATE(cv.collected_at)
+ON DUPLICATE KEY UPDATE min_views = LEAST(min_views, VALUES(min_views)),
+                        max_views = GREATEST(max_views, VALUES(max_views)),
+                        last_views = IF(VALUES(last_collect_id) >= last_collect_id, VALUES(last_views), last_views),
+                        last_collect_id = GREATEST(last_collect_id, VALUES(last_collect_id));
+
+INSERT INTO channel_daily (channel_id, day, min_subscribers, max_subscribers, last_subscribers, last_collect_id)
+SELECT cc.channel_id, DATE(cc.collected_at), MIN(cc.subscriber_count), MAX(cc.subscriber_count),
+       SUBSTRING_INDEX(GROUP_CONCAT(cc.subscriber_count ORDER BY cc.collect_id DESC), ',', 1), MAX(cc.collect_id)
+FROM collect_channel cc
+GROUP BY cc.channel_id, DATE(cc.collected_at)
+ON DUPLICATE KEY UPDATE min_subscribers = LEAST(min_subscribers, VALUES(min_subscribers)),
+                        max_subscribers = GREATEST(max_subscribers, VALUES(max_subscribers)),
+                        last_subscribers = IF(VALUES(last_collect_id) >= last_collect_id, VALUES(last_subscribers),
+                                              last_subscribers),
+                        last_collect_id = GREATEST(last_collect_id, VALUES(last_collect_id));
@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+import re
+
+# Parsers for the fixed formats returned by the YouTube Data API, much cheaper than strptime and isodate
+DURATION = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+ZERO = timedelta()
+
+
+def parse_timestamp(s, offset=ZERO):  # 'YYYY-MM-DDTHH:MM:SS(.fff)Z' to a naive datetime, shifted by offset
+    try:
+        if s[4] == '-' and s[7] == '-' and s[10] == 'T' and s[13] == ':' and s[16] == ':':
+            return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                            int(s[11:13]), int(s[14:16]), int(s[17:19])) + offset
+    except (IndexError, ValueError):
+        pass
+    raise ValueError('(timeutils.py) Invalid timestamp: {}'.format(s))
+
+
+def format_timestamp(d):  # Same as strftime('%Y-%m-%d %H:%M:%S') for datetimes without microseconds
+    return d.isoformat(' ', 'seconds')
+
+
+def parse_duration(s):  # 'P#DT#H#M#S' to seconds. Other ISO 8601 durations (weeks, months) go through isodate
+    match = DURATION.match(s)
+    if not match:
+        from isodate import parse_duration as parse_iso
+        return int(parse_iso(s).total_seconds())
+    days, hours, minutes, seconds = (int(g) if g else 0 for g in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def local_now(offset=ZERO):  # Current time shifted by offset, formatted for the database
+    return format_timestamp(datetime.now() + offset)
@@ -1,46 +1,677 @@
 
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+from contextlib import contextmanager
+from csv import DictReader
+from datetime import datetime
+from itertools import groupby
+import json
+from operator import eq, ge, gt, le, lt
+from os import fsync, getpid, kill, listdir, makedirs, name as os_name, remove, replace, utime
+from os.path import getmtime, isdir, join, splitext
+from queue import Empty, LifoQueue, Queue
+from random import uniform
+import re
+from socket import gethostname
+import sqlite3
+from tempfile import NamedTemporaryFile
+from threading import BoundedSemaphore, Lock, Thread, get_ident
+from time import monotonic, sleep, time
+from urllib.parse import urlencode
+from zlib import crc32
+from zoneinfo import ZoneInfo
+
 from pymysql import connect, MySQLError, cursors
+from requests import Session
+from requests.adapters import HTTPAdapter
 
 from configurable import Configurable
+from metrics import metrics
+
+try:
+    from fcntl import flock, LOCK_EX
+except ImportError:  # Not available on Windows
+    flock = None
+
+
+def process_alive(pid):  # Signal 0 only checks the process exists. POSIX only, on Windows it would kill it
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # Exists, owned by another user
+        pass
+    return True
+
+
+def reserve_collect_id(path):  # Increments the collect ID file, locked against concurrent runs, and returns the ID
+    with open(path + '.lock', 'a') as lock:
+        if flock:
+            flock(lock, LOCK_EX)  # Released when the file is closed
+        with open(path, 'r') as f:
+            collect_id = int(f.readline().strip())
+        with open(path + '.tmp', 'w') as tmp:
+            tmp.write(str(collect_id + 1))
+            tmp.flush()
+            fsync(tmp.fileno())
+        replace(path + '.tmp', path)
+    return collect_id
+
+
+# Parameters accepted by the list method of each YouTube Data API v3 collection, in place of the discovery document
+API_SCHEMA = {
+    'videos': {'part', 'id', 'chart', 'myRating', 'hl', 'maxHeight', 'maxResults', 'maxWidth',
+               'onBehalfOfContentOwner', 'pageToken', 'regionCode', 'videoCategoryId'},
+    'channels': {'part', 'categoryId', 'forHandle', 'forUsername', 'hl', 'id', 'managedByMe', 'maxResults', 'mine',
+                 'mySubscribers', 'onBehalfOfContentOwner', 'pageToken'},
+    'playlistItems': {'part', 'id', 'maxResults', 'onBehalfOfContentOwner', 'pageToken', 'playlistId', 'videoId'},
+    'commentThreads': {'part', 'allThreadsRelatedToChannelId', 'channelId', 'id', 'maxResults', 'moderationStatus',
+                       'order', 'pageToken', 'searchTerms', 'textFormat', 'videoId'},
+    'search': {'part', 'channelId', 'channelType', 'eventType', 'forContentOwner', 'forDeveloper', 'forMine',
+               'location', 'locationRadius', 'maxResults', 'onBehalfOfContentOwner', 'order', 'pageToken',
+               'publishedAfter', 'publishedBefore', 'q', 'regionCode', 'relevanceLanguage', 'safeSearch', 'topicId',
+               'type', 'videoCaption', 'videoCategoryId', 'videoDefinition', 'videoDimension', 'videoDuration',
+               'videoEmbeddable', 'videoLicense', 'videoPaidProductPlacement', 'videoSyndicated', 'videoType'}
+}
+
+
+def api_url(base_url, collection):
+    if collection not in API_SCHEMA:
+        raise KeyError(collection)
+    return '{}/{}'.format(base_url.rstrip('/'), collection)
+
+
+def api_params(collection, fields, key):  # Checks list() parameters against API_SCHEMA and adds the key
+    unknown = [f for f in fields if f not in API_SCHEMA[collection]]
+    if unknown or 'part' not in fields:
+        raise Exception('(tools.py) Invalid parameters for {}.list: {}'.format(collection, unknown or 'part missing'))
+    params = {k: str(v).lower() if isinstance(v, bool) else v for k, v in fields.items()}
+    params['key'] = key
+    return params
+
+
+def api_error(status, content):  # Error raised for responses that failed for good
+    return Exception('(tools.py) HttpError {} while accessing API: {}'.format(status, content[:200]))
+
+
+def quota_exceeded(status, content):  # True for 403 responses caused by an exhausted daily quota
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(content)['error'].get('errors', [])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return b'quotaExceeded' in content if isinstance(content, bytes) else 'quotaExceeded' in str(content)
+    return any(e.get('reason') in ('quotaExceeded', 'dailyLimitExceeded') for e in errors)
+
+
+def retry_reason(status, content):  # Classifies failed responses that are worth retrying
+    if quota_exceeded(status, content):
+        return 'quota'
+    if status == 429 or (status == 403 and (b'RateLimitExceeded' in content or b'rateLimitExceeded' in content)):
+        return 'throttle'
+    if status >= 500:
+        return 'server'
+    return None
+
+
+class RateLimiter():
+    # Token bucket per key. The refill rate grows additively on success and is cut multiplicatively when throttled
+
+    def __init__(self, rate=10.0, burst=10, min_rate=0.5, max_rate=50.0, increase=0.1, decrease=0.5,
+                 attempts=5, base_delay=1.0, max_delay=60.0):
+        self.initial_rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = Lock()
+        self.buckets = {}
+        self.requests = 0
+        self.retries = 0
+        self.throttles = 0
+        self.wait_time = 0.0
+
+    def bucket(self, key):
+        if key not in self.buckets:
+            self.buckets[key] = {'rate': self.initial_rate, 'tokens': float(self.burst), 'last': monotonic()}
+        return self.buckets[key]
+
+    def reserve(self, key):  # Takes a token and returns how many seconds to wait before sending the request
+        with self.lock:
+            b = self.bucket(key)
+            now = monotonic()
+            b['tokens'] = min(self.burst, b['tokens'] + (now - b['last']) * b['rate']) - 1
+            b['last'] = now
+            wait = -b['tokens'] / b['rate'] if b['tokens'] < 0 else 0.0
+            self.requests += 1
+            self.wait_time += wait
+            return wait
+
+    def success(self, key):
+        with self.lock:
+            b = self.bucket(key)
+            b['rate'] = min(self.max_rate, b['rate'] + self.increase)
+
+    def throttled(self, key):
+        with self.lock:
+            b = self.bucket(key)
+            b['rate'] = max(self.min_rate, b['rate'] * self.decrease)
+            self.throttles += 1
+
+    def backoff(self, attempt):  # Full jitter exponential backoff, in seconds
+        delay = uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        with self.lock:
+            self.retries += 1
+            self.wait_time += delay
+        return delay
+
+    def counters(self):
+        with self.lock:
+            return {'requests': self.requests, 'retries': self.retries, 'throttles': self.throttles,
+                    'wait_time': round(self.wait_time, 3),
+                    'rates': {k[-4:]: round(b['rate'], 2) for k, b in self.buckets.items()}}
+
+
+class KeyScheduler():
+    costs = {'channels': 1, 'playlistItems': 1, 'videos': 1, 'commentThreads': 1, 'search': 100}
+
+    def __init__(self, keys, daily_quota=10000, state_file=None, reset_timezone='America/Los_Angeles'):
+        self.keys = list(keys)
+        self.daily_quota = daily_quota
+        self.state_file = state_file
+        self.timezone = ZoneInfo(reset_timezone)  # Quotas reset at midnight Pacific Time
+        self.lock = Lock()
+        self.day = self.today()
+        self.spent = {k: 0 for k in self.keys}  # Units spent today, including previous runs
+        self.exhausted = set()
+        self.run_spent = {k: 0 for k in self.keys}
+        self.run_calls = {}
+        self.saved = {k: 0 for k in self.keys}  # Units of each key already in the state file
+        self.load()
+
+    def today(self):
+        return datetime.now(self.timezone).date().isoformat()
+
+    def load(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.loads(f.read())
+        except (OSError, ValueError):
+            return
+        if state.get('day') == self.day:
+            for k, v in state.get('spent', {}).items():
+                if k in self.spent:
+                    self.spent[k] = self.saved[k] = v
+            self.exhausted = set(k for k in state.get('exhausted', []) if k in self.spent)
+
+    def save(self):
+        # Adds the units spent since the last save to the state file, locked against other processes (such as other
+        # shards) saving the same file
+        if not self.state_file:
+            return
+        with open(self.state_file + '.lock', 'a') as lock:
+            if flock:
+                flock(lock, LOCK_EX)  # Released when the file is closed
+            with self.lock:
+                self.roll()
+            state = {'day': self.day, 'spent': {}, 'exhausted': []}
+            try:
+                with open(self.state_file, 'r') as f:
+                    saved = json.loads(f.read())
+                if saved.get('day') == self.day:  # Keeps the keys and spending of other processes
+                    state = saved
+            except (OSError, ValueError):
+                pass
+            with self.lock:
+                for k, v in self.spent.items():
+                    state['spent'][k] = state['spent'].get(k, 0) + v - self.saved[k]
+                    self.saved[k] = v
+                state['exhausted'] = list(set(state['exhausted']) | self.exhausted)
+            tmp = '{}.{}.tmp'.format(self.state_file, getpid())
+            with open(tmp, 'w') as f:
+                f.write(json.dumps(state))
+            replace(tmp, self.state_file)
+
+    def roll(self):
+        day = self.today()
+        if day != self.day:
+            self.day = day
+            self.spent = {k: 0 for k in self.keys}
+            self.saved = {k: 0 for k in self.keys}
+            self.exhausted.clear()
+
+    def acquire(self, collection):  # Charges the call to the key with the most quota left
+        cost = self.costs.get(collection, 1)
+        with self.lock:
+            self.roll()
+            available = [k for k in self.keys if k not in self.exhausted]
+            if not available:
+                raise Exception('(tools.py) Every API key is out of quota until the next reset.')
+            key = min(available, key=lambda k: self.spent[k])
+            self.spent[key] += cost
+            self.run_spent[key] += cost
+            self.run_calls[collection] = self.run_calls.get(collection, 0) + 1
+            return key
 
+    def exhaust(self, key):  # Takes a key out of rotation until the quota resets
+        with self.lock:
+            self.exhausted.add(key)
+            self.spent[key] = max(self.spent[key], self.daily_quota)
 
-class APIRequest():
+    def summary(self):
+        with self.lock:
+            lines = ['Quota spent in this run: {} units in {} calls ({}).'.format(
+                sum(self.run_spent.values()), sum(self.run_calls.values()),
+                ', '.join('{}: {}'.format(k, v) for k, v in sorted(self.run_calls.items())))]
+            for k in self.keys:
+                lines.append('  key ...{}: {} units this run, {}/{} today{}'.format(
+                    k[-4:], self.run_spent[k], self.spent[k], self.daily_quota,
+                    ' (quota exceeded)' if k in self.exhausted else ''))
+        return '\n'.join(lines)
 
-    def __init__(self, api_key, version='v3'):
-        self.key = api_key
-        self.build = build('youtube', version, developerKey=api_key)
-        self.collection = {'videos': self.build.videos(), 'channels': self.build.channels(),
-                           'playlistItems': self.build.playlistItems(), 'commentThreads': self.build.commentThreads(),
-                           'search': self.build.search()}
+
+class APIRequest(Configurable):
+    # Sends list requests straight to the REST endpoints. Every thread shares one session, which keeps connections
+    # alive and accepts gzip responses. The request returned by list() is its parameters, used by list_next()
+    session = None
+    session_lock = Lock()
+
+    def __init__(self, api_key=None, version='v3', scheduler=None, limiter=None, cache=None):
+        super().__init__(fields=['api'])
+        self.scheduler = scheduler
+        self.limiter = limiter
+        self.cache = cache
+        self.key = api_key or scheduler.keys[0]
+        self.base_url = self.config['api'].get('baseUrl', 'https://www.googleapis.com/youtube/{}'.format(version))
+        self.timeout = self.config['api'].get('timeout', 30)
+        with APIRequest.session_lock:
+            if APIRequest.session is None:
+                session = Session()
+                adapter = HTTPAdapter(pool_maxsize=self.config['api'].get('threads', 10))  # A connection per thread
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({'Accept-Encoding': 'gzip', 'User-Agent': 'ytmonitor (gzip)'})
+                APIRequest.session = session
+
+    def execute(self, collection, request):
+        attempt = 0
+        url = api_url(self.base_url, collection)
+        while True:
+            key = self.scheduler.acquire(collection) if self.scheduler else self.key
+            params = api_params(collection, request, key)
+            if self.limiter:
+                sleep(self.limiter.reserve(key))
+            try:
+                with metrics.timer('api_seconds', endpoint=collection):
+                    resp = self.session.get(url, params=params, timeout=self.timeout)
+                metrics.count('api_responses', endpoint=collection, status=resp.status_code)
+            except OSError as err:  # Connection errors and timeouts
+                metrics.count('api_responses', endpoint=collection, status='error')
+                if not self.limiter or attempt + 1 >= self.limiter.attempts:
+                    raise err
+            else:
+                if resp.status_code < 400:
+                    if self.limiter:
+                        self.limiter.success(key)
+                    return resp.json()
+                reason = retry_reason(resp.status_code, resp.content)
+                if reason == 'quota' and self.scheduler:
+                    self.scheduler.exhaust(key)  # The next attempt goes out with another key
+                elif reason == 'throttle' and self.limiter:
+                    self.limiter.throttled(key)
+                if not self.limiter or not reason or (reason == 'quota' and not self.scheduler) or \
+                        attempt + 1 >= self.limiter.attempts:
+                    raise api_error(resp.status_code, resp.content)
+            sleep(self.limiter.backoff(attempt))
+            attempt += 1
 
     def list(self, collection, **fields):
         try:
-            request = self.collection[collection].list(**fields)
-            return request, request.execute()
+            if not self.cache:
+                return fields, self.execute(collection, fields)
+            items, missing = self.cache.lookup(collection, fields)  # Only the ids missing from the cache are requested
+            response = self.execute(collection, missing) if missing else {}
+            return fields, self.cache.update(collection, fields, missing, items, response)
         except KeyError as err:
             raise Exception('(tools.py) KeyError while accessing API: {}'.format(repr(err)))
-        except HttpError as err:
-            raise Exception('(tools.py) HttpError while accessing API: {}'.format(repr(err)))
 
     def list_next(self, collection, request=None, response=None):
-        if request and response:
-            try:
-                request = self.collection[collection].list_next(request, response)
-                if request:
-                    return request, request.execute()
-            except KeyError as err:
-                raise Exception('(tools.py) KeyError while accessing API: {}'.format(repr(err)))
-            except HttpError as err:
-                raise Exception('(tools.py) HttpError while accessing API: {}'.format(repr(err)))
+        if request and response and response.get('nextPageToken'):
+            return self.list(collection, **dict(request, pageToken=response['nextPageToken']))
         return None, None
 
 
+class ResponseCache():
+    # On-disk cache of API responses, shared by every thread of a process. Items of requests by id (channel snippets,
+    # video metadata) are kept per id, so a batch only requests the ids missing from the cache. Statistics are never
+    # cached. Least recently used items are dropped beyond max_entries.
+    # With record, every other response is kept as well, and offline mode answers from the cache only
+    cacheable_fields = {'part', 'id', 'maxResults'}
+
+    def __init__(self, path, ttl=None, max_entries=100000, offline=False, record=False, missing_ttl=0):
+        self.ttl = ttl or {}  # Seconds items of each collection are kept. Collections not listed are not cached
+        self.missing_ttl = missing_ttl  # Seconds an id the API returned no item for is kept. 0 never serves them
+        self.max_entries = max_entries
+        self.offline = offline
+        self.record = record or offline
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS response '
+                              '(key TEXT PRIMARY KEY, body TEXT, stored_at REAL, used_at REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS response_used ON response (used_at)')
+            self.count = self.conn.execute('SELECT COUNT(*) FROM response').fetchone()[0]
+
+    def cacheable(self, collection, fields):  # True for requests by id of slowly changing parts
+        return collection in self.ttl and 'id' in fields and all(f in self.cacheable_fields for f in fields) and \
+            'statistics' not in str(fields['part']).split(',')
+
+    def request_key(self, collection, fields):
+        return '{}?{}'.format(collection, urlencode(sorted(fields.items())))
+
+    def get(self, keys, max_age):
+        # Cached bodies of the keys stored less than max_age seconds ago (missing_ttl for ids without an item)
+        now = time()
+        oldest = [now - self.missing_ttl, now - max_age] if max_age else [0, 0]
+        with self.lock, self.conn:
+            rows = self.conn.execute('SELECT key, body FROM response WHERE key IN ({}) AND stored_at > '
+                                     "CASE WHEN body = 'null' THEN ? ELSE ? END".format(', '.join(['?'] * len(keys))),
+                                     list(keys) + oldest).fetchall()
+            self.conn.executemany('UPDATE response SET used_at = ? WHERE key = ?', [(now, k) for k, b in rows])
+        return dict(rows)
+
+    def put(self, bodies):
+        now = time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO response (key, body, stored_at, used_at) VALUES (?, ?, ?, ?)',
+                                  [(k, b, now, now) for k, b in bodies.items()])
+            self.count += len(bodies)
+            if self.count > self.max_entries:  # Drops a tenth more than needed, so eviction does not run every time
+                self.conn.execute('DELETE FROM response WHERE key IN (SELECT key FROM response ORDER BY used_at '
+                                  'LIMIT ?)', (self.count - self.max_entries + self.max_entries // 10,))
+                self.count = self.conn.execute('SELECT COUNT(*) FROM response').fetchone()[0]
+
+    def lookup(self, collection, fields):
+        # Returns the cached items of the request, and the parameters of the request still to be sent (None if
+        # everything was cached)
+        if self.cacheable(collection, fields):
+            ids = str(fields['id']).split(',')
+            keys = {'{}|{}|{}'.format(collection, fields['part'], i): i for i in ids}
+            bodies = self.get(keys, None if self.offline else self.ttl[collection])
+            missing = [i for k, i in keys.items() if k not in bodies]
+            items = [json.loads(b) for b in bodies.values() if b != 'null']  # null: the API returned no item for it
+            hits, misses = len(keys) - len(missing), len(missing)
+        elif self.offline or self.record:
+            key = self.request_key(collection, fields)
+            bodies = self.get([key], None) if self.offline else {}
+            missing = [] if bodies else [key]
+            items = [json.loads(bodies[key])] if bodies else []
+            hits, misses = len(bodies), len(missing)
+        else:
+            return [], fields
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+        if missing and self.offline:
+            raise Exception('(tools.py) {} {} not in the response cache (offline mode).'.format(collection, missing))
+        if not missing:
+            return items, None
+        return items, dict(fields, id=','.join(missing)) if self.cacheable(collection, fields) else fields
+
+    def update(self, collection, fields, missing, items, response):
+        # Caches the response to the parameters returned by lookup() and adds the cached items to it
+        if missing is fields and not self.record:
+            return response
+        if not self.cacheable(collection, fields):
+            if missing:
+                self.put({self.request_key(collection, fields): json.dumps(response)})
+            return response if missing else items[0]
+        fetched = response.get('items', [])
+        if missing:
+            # Ids without an item are only kept for missing_ttl, or for offline replay
+            by_id = {item.get('id'): item for item in fetched}
+            keep_missing = self.missing_ttl or self.record
+            self.put({'{}|{}|{}'.format(collection, fields['part'], i): json.dumps(by_id.get(i))
+                      for i in missing['id'].split(',') if i in by_id or keep_missing})
+        order = {i: n for n, i in enumerate(str(fields['id']).split(','))}
+        items = sorted(items + fetched, key=lambda item: order.get(item.get('id'), len(order)))
+        return dict(response, items=items, pageInfo={'totalResults': len(items), 'resultsPerPage': len(items)})
+
+    def counters(self):  # Cached items served and items requested from the API
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+SEPARATORS = re.compile(r'[ \t\r\n,]*')  # Skipped between the items of a JSON list file
+
+
+class ChannelSource(Configurable):
+    # Lazily reads channel IDs from a CSV, JSON or plain list file, applying files.filter to each row
+    operators = {'greater': gt, 'less': lt, 'greater_equal': ge, 'less_equal': le, 'equal': eq}
+
+    def __init__(self, path=None):
+        super().__init__(fields=['files'])
+        self.path = path or self.config['files']['listFile']
+        self.encoding = self.config['files'].get('encoding', 'utf8')
+        self.csv = self.config['files'].get('csv') or {}
+        self.filters = self.config['files'].get('filter') or []
+
+    def __iter__(self):
+        extension = splitext(self.path)[1].lower()
+        with open(self.path, 'r', encoding=self.encoding, newline='' if extension == '.csv' else None) as f:
+            if extension == '.csv':
+                rows = DictReader(f, delimiter=self.csv.get('delimiter', ','), quotechar=self.csv.get('quoteChar', '"'))
+                missing = [a for a in self.attributes() if a not in (rows.fieldnames or [])]
+                if missing:  # Every row would be filtered out
+                    raise Exception('(tools.py) Filter attributes missing from the header of {}: {}'.format(
+                        self.path, missing))
+            elif extension in ('.json', '.jsonl'):
+                rows = self.read_json(f)
+            else:
+                for i, line in enumerate(f):  # Plain lists have no attributes to filter on
+                    line = line.strip()
+                    if line and not (i == 0 and line in ('channel_id', 'channelId')):  # Skips a header line
+                        yield line
+                return
+            for row in rows:
+                if isinstance(row, str):
+                    row = {'channel_id': row}
+                channel_id = row.get('channel_id') or row.get('channelId')
+                if channel_id and self.accept(row):
+                    yield channel_id
+
+    def attributes(self):
+        return [f.get('attribute', f.get('name')) for f in self.filters]
+
+    def accept(self, row):
+        for f, attribute in zip(self.filters, self.attributes()):
+            try:
+                value = float(row[attribute])
+            except (KeyError, TypeError, ValueError):
+                return False
+            if not self.operators[f['type']](value, f['value']):
+                return False
+        return True
+
+    def read_json(self, f, chunk_size=1 << 16):
+        # Decodes the objects of a top-level array (or of JSON lines) one at a time, reading the file in chunks. The
+        # buffer is only trimmed when a chunk is added, items are decoded in place from an index
+        decoder = json.JSONDecoder()
+        buffer = f.read(chunk_size).lstrip()
+        idx = 1 if buffer.startswith('[') else 0
+        eof = False
+        while True:
+            idx = SEPARATORS.match(buffer, idx).end()
+            if buffer.startswith(']', idx) or (eof and idx == len(buffer)):
+                return
+            try:
+                item, idx = decoder.raw_decode(buffer, idx)
+            except ValueError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[idx:] + chunk
+                idx = 0
+                continue
+            yield item
+
+
+class StateStore():
+    # Local SQLite file keeping collection state between runs, shared by every thread of a process
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS watermark '
+                              '(channel_id TEXT PRIMARY KEY, published_at TEXT, video_id TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS active_video '
+                              '(video_id TEXT PRIMARY KEY, channel_id TEXT, published_at TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS active_video_channel ON active_video (channel_id)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS run '
+                              '(collect_id INTEGER PRIMARY KEY, started_at TEXT, finished_at TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS run_channel (collect_id INTEGER, channel_id TEXT, '
+                              'completed_at TEXT, PRIMARY KEY (collect_id, channel_id))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS run_flush '
+                              '(collect_id INTEGER, table_name TEXT, row_count INTEGER, flushed_at TEXT)')
+
+    def watermark(self, channel_id):  # (published_at, video_id) of the newest video seen, or None
+        with self.lock:
+            return self.conn.execute('SELECT published_at, video_id FROM watermark WHERE channel_id = ?',
+                                     (channel_id,)).fetchone()
+
+    def active_videos(self, channel_id, since):
+        with self.lock:
+            rows = self.conn.execute('SELECT video_id FROM active_video WHERE channel_id = ? AND published_at >= ?',
+                                     (channel_id, since)).fetchall()
+        return [r[0] for r in rows]
+
+    def update_channel(self, channel_id, videos, since, advance_watermark=True):
+        # Adds newly found (video_id, published_at) pairs, drops videos older than since and moves the watermark
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO active_video (video_id, channel_id, published_at) '
+                                  'VALUES (?, ?, ?)', [(v, channel_id, p) for v, p in videos])
+            self.conn.execute('DELETE FROM active_video WHERE channel_id = ? AND published_at < ?', (channel_id, since))
+            if advance_watermark and videos:
+                video_id, published_at = max(videos, key=lambda v: v[1])
+                self.conn.execute('INSERT OR REPLACE INTO watermark (channel_id, published_at, video_id) '
+                                  'VALUES (?, ?, ?)', (channel_id, published_at, video_id))
+
+    def start_run(self, collect_id):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO run (collect_id, started_at) VALUES (?, datetime('now'))",
+                              (collect_id,))
+
+    def finish_run(self, collect_id):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE run SET finished_at = datetime('now') WHERE collect_id = ?", (collect_id,))
+
+    def unfinished_run(self):  # Collect ID of the latest run that did not finish, or None
+        with self.lock:
+            row = self.conn.execute('SELECT collect_id, finished_at FROM run '
+                                    'ORDER BY collect_id DESC LIMIT 1').fetchone()
+        return row[0] if row and row[1] is None else None
+
+    def completed_channels(self, collect_id):
+        with self.lock:
+            rows = self.conn.execute('SELECT channel_id FROM run_channel WHERE collect_id = ?',
+                                     (collect_id,)).fetchall()
+        return set(r[0] for r in rows)
+
+    def complete_channels(self, collect_id, channels):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO run_channel (collect_id, channel_id, completed_at) "
+                                  "VALUES (?, ?, datetime('now'))", [(collect_id, c) for c in channels])
+
+    def record_flush(self, collect_id, table, rows):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO run_flush (collect_id, table_name, row_count, flushed_at) "
+                              "VALUES (?, ?, ?, datetime('now'))", (collect_id, table, rows))
+
+
+class ConnectionPool():
+
+    def __init__(self, connection, size=10, timeout=30, ping_interval=60):
+        self.connection_args = dict(connection)
+        self.connection_args.setdefault('autocommit', True)  # Reused connections must not keep a stale snapshot
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.idle = LifoQueue()
+        self.slots = BoundedSemaphore(size)
+
+    def checkout(self):
+        while True:
+            try:
+                conn, last_used = self.idle.get_nowait()
+            except Empty:
+                return connect(**self.connection_args)
+            try:
+                if monotonic() - last_used > self.ping_interval:
+                    conn.ping(reconnect=True)  # Health check, reconnects stale connections
+                return conn
+            except MySQLError:
+                self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise Exception('(tools.py) Timed out waiting for a database connection.')
+        conn = None
+        try:
+            conn = self.checkout()
+            yield conn
+            self.idle.put((conn, monotonic()))
+        except BaseException:  # Includes GeneratorExit from a stream that was not read to the end
+            if conn:
+                self.discard(conn)  # Connection state is unknown after an error
+            raise
+        finally:
+            self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                conn, last_used = self.idle.get_nowait()
+            except Empty:
+                break
+            self.discard(conn)
+
+
 class Database(Configurable):
+    pool = None
+    pool_lock = Lock()
+    # Daily rollups kept up to date with the collect tables: rollup table, key, collected column, rollup column name
+    rollups = {'collect_video': ('video_daily', 'video_id', 'view_count', 'views'),
+               'collect_channel': ('channel_daily', 'channel_id', 'subscriber_count', 'subscribers')}
 
     def __init__(self):
         super().__init__(fields=['database'])
+        with Database.pool_lock:  # Every Database instance in the process shares the same pool
+            if Database.pool is None:
+                settings = self.config['database'].get('pool') or {}
+                connection = dict(self.config['database']['connection'])
+                if self.config['database'].get('loadDataThreshold'):
+                    connection.setdefault('local_infile', True)  # Allows LOAD DATA LOCAL INFILE
+                Database.pool = ConnectionPool(connection,
+                                               size=settings.get('size', 10),
+                                               timeout=settings.get('timeout', 30),
+                                               ping_interval=settings.get('pingInterval', 60))
+
+    def connection(self):
+        return self.pool.connection()
 
     def select(self, table, *columns, where=None):
         result = []
@@ -53,8 +684,7 @@ class Database(Configurable):
         if not columns:
             columns = ['*']
         try:
-            conn = connect(**self.config['database']['connection'])
-            try:
+            with metrics.timer('db_seconds', call='select', table=table), self.connection() as conn:
                 with conn.cursor(cursors.DictCursor) as cursor:
                     query = {'table': table, 'columns': ', '.join(columns), 'where': ''}
                     if where:
@@ -62,14 +692,33 @@ class Database(Configurable):
                     sql = 'SELECT %(columns)s from %(table)s %(where)s' % query
                     cursor.execute(sql)
                     result = cursor.fetchall()
-            except MySQLError as err:
-                raise Exception(repr(err))
-            finally:
-                conn.close()
         except MySQLError as err:
             raise Exception('(tools.py) MySQLError while accessing API: {}'.format(repr(err)))
         return result
 
+    def stream(self, sql, args=None):  # Yields the rows of a query one at a time, with an unbuffered cursor
+        try:
+            with self.connection() as conn:
+                with conn.cursor(cursors.SSDictCursor) as cursor:
+                    with metrics.timer('db_seconds', call='stream'):  # Until the first rows arrive
+                        cursor.execute(sql, args)
+                    for row in cursor:
+                        yield row
+        except MySQLError as err:
+            raise Exception('(tools.py) MySQLError while accessing database: {}'.format(repr(err)))
+
+    def pages(self, table, key, columns, size=1000):
+        # Yields the rows of a table page by page, in order of its integer key. No connection is held between pages
+        last = 0
+        while True:
+            sql = 'SELECT {0}, {1} FROM {2} WHERE {0} > %s ORDER BY {0} LIMIT %s'.format(key, ', '.join(columns), table)
+            rows = list(self.stream(sql, (last, size)))
+            for row in rows:
+                yield row
+            if len(rows) < size:
+                return
+            last = rows[-1][key]
+
     def insert(self, table, values):
         many = False
         columns = []
@@ -94,8 +743,7 @@ class Database(Configurable):
                 raise Exception('(tools.py) KeyError while accessing database: Invalid columns.')
             data = tuple([values[c] for c in columns])
         try:
-            conn = connect(**self.config['database']['connection'])
-            try:
+            with metrics.timer('db_seconds', call='insert', table=table), self.connection() as conn:
                 with conn.cursor() as cursor:
                     query = {'table': table, 'columns': ', '.join(columns), 'values': ', '.join(['%s'] * len(columns))}
                     sql = 'INSERT INTO %(table)s (%(columns)s) VALUES (%(values)s)' % query
@@ -105,10 +753,273 @@ class Database(Configurable):
                         cursor.execute(sql, data)
                     conn.commit()
                     last_id = cursor.lastrowid
-            except MySQLError as err:
-                raise Exception(repr(err))
-            finally:
-                conn.close()
         except MySQLError as err:
             raise Exception('(tools.py) MySQLError while accessing database: {}'.format(repr(err)))
         return last_id
+
+    def table_fields(self, table):  # Fields and primary key columns of a table in config.json
+        try:
+            table = next(t for t in self.config['database']['tables'] if t['name'] == table)
+        except StopIteration as err:
+            raise Exception('(tools.py) KeyError while accessing database: Invalid table. {}'.format(repr(err)))
+        key = table.get('primaryKey') or []
+        return table['fields'], [key] if isinstance(key, str) else key
+
+    def row_columns(self, table, rows):  # Columns shared by every row of a batch
+        fields, key = self.table_fields(table)
+        columns = list(rows[0].keys())
+        if not all(c in fields for c in columns) or any(list(r.keys()) != columns for r in rows):
+            raise Exception('(tools.py) KeyError while accessing database: Invalid columns.')
+        return columns, key
+
+    def upsert(self, table, rows, batch=1000):
+        # Saves rows with multi-row INSERT statements, updating the rows whose keys already exist
+        columns, key = self.row_columns(table, rows)
+        update = [c for c in columns if c not in key] or columns[:1]
+        try:
+            with metrics.timer('db_seconds', call='upsert', table=table), self.connection() as conn:
+                with conn.cursor() as cursor:
+                    for i in range(0, len(rows), batch):
+                        chunk = rows[i:i + batch]
+                        values = ', '.join(['({})'.format(', '.join(['%s'] * len(columns)))] * len(chunk))
+                        sql = 'INSERT INTO {} ({}) VALUES {} ON DUPLICATE KEY UPDATE {}'.format(
+                            table, ', '.join(columns), values, ', '.join('{0} = VALUES({0})'.format(c) for c in update))
+                        cursor.execute(sql, [r[c] for r in chunk for c in columns])
+                    conn.commit()
+        except MySQLError as err:
+            raise Exception('(tools.py) MySQLError while accessing database: {}'.format(repr(err)))
+
+    @staticmethod
+    def rollup_days(key, column, rows):  # Lowest, highest and latest (by collect ID) value of each key and day
+        days = {}
+        for r in rows:
+            value = int(r[column] or 0)
+            day = days.setdefault((r[key], str(r['collected_at'])[:10]), [value, value, value, r['collect_id']])
+            day[0], day[1] = min(day[0], value), max(day[1], value)
+            if r['collect_id'] >= day[3]:
+                day[2], day[3] = value, r['collect_id']
+        return [k + tuple(v) for k, v in days.items()]
+
+    def rollup(self, table, rows, batch=1000):
+        # Folds collect rows into the daily rollup of their table (see rollups.sql)
+        rollup, key, column, name = self.rollups[table]
+        days = self.rollup_days(key, column, rows)
+        try:
+            with metrics.timer('db_seconds', call='rollup', table=rollup), self.connection() as conn:
+                with conn.cursor() as cursor:
+                    for i in range(0, len(days), batch):
+                        chunk = days[i:i + batch]
+                        sql = ('INSERT INTO {0} ({1}, day, min_{2}, max_{2}, last_{2}, last_collect_id) VALUES {3} '
+                               'ON DUPLICATE KEY UPDATE min_{2} = LEAST(min_{2}, VALUES(min_{2})), '
+                               'max_{2} = GREATEST(max_{2}, VALUES(max_{2})), '
+                               'last_{2} = IF(VALUES(last_collect_id) >= last_collect_id, VALUES(last_{2}), last_{2}), '
+                               'last_collect_id = GREATEST(last_collect_id, VALUES(last_collect_id))').format(
+                            rollup, key, name, ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(chunk)))
+                        cursor.execute(sql, [v for d in chunk for v in d])
+                    conn.commit()
+        except MySQLError as err:
+            raise Exception('(tools.py) MySQLError while accessing database: {}'.format(repr(err)))
+
+    @staticmethod
+    def load_value(value):  # Escapes a value for the tab-separated file read by LOAD DATA
+        if value is None:
+            return '\\N'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+    def load_data(self, table, rows):
+        # Bulk loads rows from a temporary tab-separated file, replacing the rows whose keys already exist.
+        # The server must allow local_infile
+        columns, key = self.row_columns(table, rows)
+        with NamedTemporaryFile('w', suffix='.tsv', encoding='utf8', newline='\n', delete=False) as f:
+            for r in rows:
+                f.write('\t'.join(self.load_value(r[c]) for c in columns) + '\n')
+        try:
+            with metrics.timer('db_seconds', call='load_data', table=table), self.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE {} CHARACTER SET utf8mb4 "
+                                   "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({})".format(
+                                       table, ', '.join(columns)), (f.name,))
+                    conn.commit()
+        except MySQLError as err:
+            raise Exception('(tools.py) MySQLError while accessing database: {}'.format(repr(err)))
+        finally:
+            remove(f.name)
+
+
+class DatabaseWriter(Configurable):
+    # Saves queued rows in batches from one or more writer threads. Every row and channel marker carries its channel
+    # ID and is routed by it, so a channel's marker is always flushed by the same writer, after the channel's rows
+    claim_timeout = 3600  # Seconds after which a spill file claimed by another host is replayed again
+
+    def __init__(self, logger, on_saved=None, on_channels=None):
+        super().__init__(fields=['database', 'files'])
+        settings = self.config['database']
+        self.logger = logger
+        self.on_saved = on_saved  # Called with (table, number of rows) after each saved batch
+        self.on_channels = on_channels  # Called with the channels whose rows were all saved
+        self.buffer_limit = settings.get('bufferLimit', 1000)
+        self.interval = settings.get('flushInterval', 5)
+        self.load_threshold = settings.get('loadDataThreshold', 0)
+        self.rollups = settings.get('rollups', False)
+        self.spill_directory = self.config['files'].get('spillDirectory', 'spill')
+        self.db = Database()
+        self.queues = [Queue() for _ in range(max(1, settings.get('writers', 1)))]
+        self.threads = [Thread(target=self.run, args=(q,), name='db_thread_{}'.format(i))
+                        for i, q in enumerate(self.queues)]
+
+    def put(self, query):
+        if query['table']:
+            metrics.count('rows_queued', table=query['table'])
+        self.queues[crc32(query['channel'].encode()) % len(self.queues)].put(query)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def close(self):  # Stops the writers once they have saved everything queued before
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+    def run(self, queue):  # Flushes when the buffer is full or flushInterval seconds after the last flush
+        buffer = []
+        deadline = monotonic() + self.interval
+        while True:
+            start = monotonic()
+            try:
+                query = queue.get(timeout=max(0, deadline - start))
+            except Empty:
+                query = False
+            metrics.thread_time(monotonic() - start, busy=False)
+            if query is None:
+                break
+            if query:
+                buffer.append(query)
+            if len(buffer) >= self.buffer_limit or monotonic() >= deadline:
+                if buffer:
+                    start = monotonic()
+                    self.flush(buffer)
+                    metrics.thread_time(monotonic() - start)
+                    buffer = []
+                deadline = monotonic() + self.interval
+        if buffer:
+            start = monotonic()
+            self.flush(buffer)
+            metrics.thread_time(monotonic() - start)
+
+    def flush(self, buffer):
+        # Channel markers are reported only once every row queued before them has been saved
+        channels = [q['channel'] for q in buffer if q['table'] is None]
+        rows = sorted((q for q in buffer if q['table'] is not None), key=lambda q: q['table'])
+        saved = True
+        for table, group in groupby(rows, key=lambda q: q['table']):
+            if not self.write(table, [q['columns'] for q in group]):
+                saved = False
+        if saved and channels and self.on_channels:
+            self.on_channels(channels)
+
+    def write(self, table, rows, attempts=3):
+        for attempt in range(attempts):
+            try:
+                self.save(table, rows)
+                if self.on_saved:
+                    self.on_saved(table, len(rows))
+                break
+            except Exception as err:
+                self.logger.error('Failed to save to database: {} Attempting {} more times.'.format(
+                    repr(err), attempts - attempt - 1))
+                if attempt + 1 < attempts:
+                    sleep(2 ** attempt)
+        else:
+            self.spill(table, rows)
+            return False
+        self.fold(table, rows)
+        return True
+
+    def save(self, table, rows):  # Saves a batch. Safe to repeat
+        if self.load_threshold and len(rows) >= self.load_threshold:
+            self.db.load_data(table, rows)
+        else:
+            self.db.upsert(table, rows)
+
+    def fold(self, table, rows):
+        # Folds saved rows into their daily rollup. A failure leaves the rows saved and spills only the rollup step
+        if not self.rollups or table not in self.db.rollups:
+            return
+        try:
+            self.db.rollup(table, rows)
+        except Exception as err:
+            self.logger.error('Failed to update the {} rollup: {}'.format(table, repr(err)))
+            self.spill(table, rows, rollup=True)
+
+    def spill(self, table, rows, rollup=False):  # Keeps a batch that could not be saved, to be replayed by the next run
+        makedirs(self.spill_directory, exist_ok=True)
+        path = join(self.spill_directory, '{}{}_{}_{}.jsonl'.format('rollup_' if rollup else '', table,
+                                                                   int(time() * 1000), get_ident()))
+        with open(path, 'w', encoding='utf8') as f:
+            for r in rows:
+                f.write(json.dumps({'table': table, 'columns': r, 'rollup': rollup}, default=str) + '\n')
+        self.logger.error('Spilled {} {} {}rows to {}.'.format(len(rows), table, 'rollup ' if rollup else '', path))
+
+    def replay(self):
+        # Saves the batches spilled by earlier runs. Each file is first claimed with an atomic rename, so processes
+        # sharing the directory (the shards of a collect) never replay the same file
+        replayed = 0
+        if not isdir(self.spill_directory):
+            return replayed
+        self.release_stale_claims()
+        for name in sorted(listdir(self.spill_directory)):
+            if not name.endswith('.jsonl'):
+                continue
+            path = join(self.spill_directory, name)
+            claimed = '{}.{}_{}.replaying'.format(path, gethostname(), getpid())
+            try:
+                replace(path, claimed)
+                utime(claimed)  # Claim time, checked by release_stale_claims
+            except OSError:  # Already claimed by another process
+                continue
+            try:
+                with open(claimed, 'r', encoding='utf8') as f:
+                    queries = [json.loads(line) for line in f if line.strip()]
+                for (table, rollup), group in groupby(queries, key=lambda q: (q['table'], q.get('rollup', False))):
+                    rows = [q['columns'] for q in group]
+                    if rollup:  # Rows already saved, only their rollup is pending
+                        if self.rollups:
+                            self.db.rollup(table, rows)
+                        else:
+                            raise Exception('(tools.py) Rollups are disabled.')
+                    else:
+                        self.save(table, rows)
+                        self.fold(table, rows)
+                remove(claimed)
+            except Exception as err:
+                self.logger.error('Failed to replay {}: {}'.format(path, repr(err)))
+                replace(claimed, path)  # Released for the next run
+                continue
+            replayed += len(queries)
+        return replayed
+
+    def release_stale_claims(self):
+        # Renames back the files claimed by replays that died: processes of this host that are gone, or claims of
+        # other hosts older than claim_timeout
+        host = gethostname()
+        for name in listdir(self.spill_directory):
+            if not name.endswith('.replaying'):
+                continue
+            path = join(self.spill_directory, name)
+            original, owner = name[:-len('.replaying')].split('.jsonl.', 1)
+            owner_host, owner_pid = owner.rsplit('_', 1)
+            try:
+                if owner_host == host and os_name == 'posix':
+                    if process_alive(int(owner_pid)):
+                        continue
+                elif time() - getmtime(path) < self.claim_timeout:
+                    continue
+                replace(path, join(self.spill_directory, original + '.jsonl'))
+                self.logger.warning('Released {}, claimed by a replay that did not finish.'.format(name))
+            except (OSError, ValueError):
+                continue  # Released or removed by another process meanwhile